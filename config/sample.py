@@ -6,6 +6,26 @@ ADMINS = [ADMIN_EMAIL]
 DATA_DIR = '{{ data_dir }}'
 CACHE_DIR = '{{ cache_dir }}'
 OVERPASS_DIR = '{{ overpass_dir }}'
+# chunk downloads task_queue.py keeps in flight, limited by Overpass slots
+OVERPASS_CHUNK_WORKERS = 4
+# queued places are saved here so they survive a task queue restart
+TASK_QUEUE_STATE = '{{ overpass_dir }}/task_queue.json'
+# Overpass responses are shared between places via OVERPASS_DIR/cache
+OVERPASS_CACHE_TTL = 24 * 60 * 60         # seconds
+OVERPASS_CACHE_MAX_SIZE = 10 * 1024 ** 3  # bytes, least recently used go first
+# gzip Overpass XML downloads, readers detect compressed files
+OVERPASS_COMPRESS = True
+# Overpass downloads up to this size skip osm2pgsql and load in process
+OSM_LOADER_MAX_SIZE = 50 * 1024 * 1024  # bytes
+# OSM imports (osm2pgsql or the in process loader) allowed at the same time
+IMPORT_SLOTS = 2
+OSM2PGSQL_MAX_CACHE = 4000  # MB, lowered to fit the free memory
+OSM2PGSQL_MAX_PROCESSES = 4
+# OSM tables of the least recently used places are dropped to stay below this
+PLACE_TABLES_MAX_SIZE = 200 * 1024 ** 3  # bytes
+# keep OSM objects in shared osm_point/line/polygon tables with a place
+# membership table, instead of a set of osm_{place_id}_* tables per place
+OSM_SHARED_TABLES = False
 LOG_DIR = '{{ log_dir }}'
 WEBASSET_CACHE = '{{ webasset_cache_dir }}'
 
@@ -16,6 +36,22 @@ TEMPLATES_AUTO_RELOAD = True
 PLACE_MIN_AREA = 1      # km^2
 PLACE_MAX_AREA = 90000  # km^2
 
+# query.wikidata.org allows five concurrent queries per IP address
+WIKIDATA_MAX_CONCURRENT_QUERIES = 5
+# wbgetentities pages to fetch in parallel
+WIKIDATA_MAX_CONCURRENT_REQUESTS = 4
+
+# local copy of Wikidata entities, shared between places and processes
+ENTITY_STORE_DIR = '{{ cache_dir }}/entities'
+# seconds before a stored entity is revalidated against its lastrevid
+ENTITY_STORE_MAX_AGE = 3600
+
+# Wikipedia API requests in flight, in total and for each language
+WIKIPEDIA_MAX_CONCURRENT_REQUESTS = 8
+WIKIPEDIA_MAX_REQUESTS_PER_HOST = 3
+# seconds before cached enwiki page categories are fetched again
+PAGE_CATEGORIES_MAX_AGE = 604800
+
 DB_NAME = '{{ db_name }}'
 DB_USER = '{{ db_user }}'
 DB_PASS = '{{ db_pass }}'
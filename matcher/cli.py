@@ -3,8 +3,8 @@ from .view import app, get_top_existing, get_existing
 from .model import (Item, Changeset, get_bad, Base, ItemCandidate, Language,
                     LanguageLabel, PlaceItem, OsmCandidate, IsA, User, Extract,
                     ChangesetEdit, EditMatchReject)
-from .place import Place
-from . import database, mail, matcher, nominatim, utils, netstring, wikidata, osm_api
+from .place import Place, evict_place_tables, import_extract, extract_prefix, osm_tables
+from . import database, mail, matcher, nominatim, utils, netstring, wikidata, osm_api, overpass
 from social.apps.flask_app.default.models import UserSocialAuth, Nonce, Association
 from datetime import datetime, timedelta
 from tabulate import tabulate
@@ -22,8 +22,11 @@ import os.path
 import re
 import json
 import click
+import humanize
 import socket
 import sys
+import traceback
+import multiprocessing
 
 @app.cli.command()
 def create_db():
@@ -36,6 +39,9 @@ def get_place(place_identifier):
     app.config.from_object('config.default')
     database.init_app(app)
 
+    return lookup_place(place_identifier)
+
+def lookup_place(place_identifier):
     if place_identifier.isdigit():
         return Place.query.get(place_identifier)
     else:
@@ -386,10 +392,12 @@ def add_to_queue(place_identifier):
     }
 
     netstring.write(sock, json.dumps(msg))
-    reply = netstring.read(sock)
+    reader = netstring.Reader(sock)
+    reply = reader.read()
     print(reply)
+    netstring.write(sock, 'ack')
     while True:
-        from_network = netstring.read(sock)
+        from_network = reader.read()
         print('from network:', from_network)
         if from_network is None:
             break
@@ -476,7 +484,7 @@ def find_item_matches(place_identifier, qid):
     for k, v in item.names().items():
         print((k, v))
     print('NRHP:', item.ref_nrhp())
-    candidates = matcher.find_item_matches(cur, item, place.prefix, debug=True)
+    candidates = matcher.find_item_matches(cur, item, place.osm_source, debug=True)
     print('candidate count:', len(candidates))
 
     for c in candidates:
@@ -817,9 +825,12 @@ def load_item_candidate_geom():
 
     for num, c in enumerate(q):
         for place in c.item.places:
-            table = place.prefix + '_' + c.planet_table
-            if table not in tables:
-                continue
+            if place.shared_osm_tables:
+                table = f'osm_{c.planet_table}'
+            else:
+                table = place.prefix + '_' + c.planet_table
+                if table not in tables:
+                    continue
             sql = f'select ST_AsText(ST_Transform(way, 4326)) from {table} where osm_id={c.src_id}'
             cur.execute(sql)
             row = cur.fetchone()
@@ -1062,7 +1073,8 @@ def refresh_all_extracts():
         def progress(item):
             print('  ', item.label())
 
-        place.load_extracts(progress=progress)
+        place.load_extracts(progress=progress, only_changed=True)
+        database.session.commit()
         print()
 
 @app.cli.command()
@@ -1106,3 +1118,230 @@ def larger_areas():
         for a in p.is_in():
             print(a['tags'].get('name:en', a['tags']['name']))
         print()
+
+@app.cli.command()
+@click.option('--batch-size', default=1000)
+def trim_item_entities(batch_size):
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    last_id = 0
+    trimmed_count = 0
+    while True:
+        q = (Item.query.filter(Item.item_id > last_id, Item.entity.isnot(None))
+                       .order_by(Item.item_id)
+                       .limit(batch_size))
+        items = q.all()
+        if not items:
+            break
+        for item in items:
+            trimmed = wikidata.trim_entity(item.entity)
+            if trimmed != item.entity:
+                item.entity = trimmed
+                trimmed_count += 1
+        last_id = items[-1].item_id
+        database.session.commit()
+        database.session.expunge_all()
+        print(last_id, trimmed_count)
+
+@app.cli.command()
+def item_entity_jsonb():
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    sql = 'ALTER TABLE item ALTER COLUMN entity TYPE jsonb USING entity::jsonb'
+    database.session.execute(sql)
+    database.session.commit()
+
+@app.cli.command()
+def isa_graph_column():
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    sql = 'ALTER TABLE isa ADD COLUMN IF NOT EXISTS graph json'
+    database.session.execute(sql)
+    database.session.commit()
+
+@app.cli.command()
+def extract_revid_column():
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    sql = 'ALTER TABLE extract ADD COLUMN IF NOT EXISTS revid bigint'
+    database.session.execute(sql)
+    database.session.commit()
+
+@app.cli.command()
+def place_last_accessed_column():
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    sql = 'ALTER TABLE place ADD COLUMN IF NOT EXISTS last_accessed timestamp'
+    database.session.execute(sql)
+    database.session.commit()
+
+@app.cli.command()
+def place_shared_osm_tables_column():
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    sql = 'ALTER TABLE place ADD COLUMN IF NOT EXISTS shared_osm_tables boolean default false'
+    database.session.execute(sql)
+    database.session.commit()
+
+@app.cli.command()
+def place_osm_loaded_column():
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    sql = 'ALTER TABLE place ADD COLUMN IF NOT EXISTS osm_loaded timestamp'
+    database.session.execute(sql)
+    database.session.commit()
+
+@app.cli.command()
+def place_item_fingerprint_column():
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    sql = 'ALTER TABLE place_item ADD COLUMN IF NOT EXISTS fingerprint varchar'
+    database.session.execute(sql)
+    database.session.commit()
+
+@app.cli.command()
+def compress_overpass():
+    ''' gzip the uncompressed XML downloads in OVERPASS_DIR. '''
+    app.config.from_object('config.default')
+
+    saved = 0
+    for f in os.scandir(app.config['OVERPASS_DIR']):
+        if not f.is_file() or not f.name.endswith('.xml'):
+            continue
+        if utils.is_gzip(f.path):
+            continue
+        if not overpass.xml_complete(f.path):
+            print('skipping incomplete', f.name)
+            continue  # compressed files are assumed to be complete
+        before = f.stat().st_size
+        utils.gzip_file(f.path)
+        saved += before - os.path.getsize(f.path)
+        print(f.name)
+    print('saved {:,d} bytes'.format(saved))
+
+@app.cli.command()
+@click.option('--max-size', type=int, help='bytes, default PLACE_TABLES_MAX_SIZE')
+@click.option('--dry-run', is_flag=True)
+def evict_osm_tables(max_size, dry_run):
+    ''' Drop OSM tables of the least recently used places to save space. '''
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    evicted = evict_place_tables(max_size=max_size, dry_run=dry_run)
+    for place, size in evicted:
+        print('{:>10s}  {}'.format(humanize.naturalsize(size),
+                                   place.display_name))
+    total = sum(size for place, size in evicted)
+    print('{} places, {}'.format(len(evicted), humanize.naturalsize(total)))
+
+@app.cli.command()
+@click.argument('place_identifier')
+@click.option('--file', 'filename', help='osmChange file, default Overpass')
+def apply_osm_change(place_identifier, filename):
+    ''' Update the OSM tables of a place with the changes since they were
+        loaded, items near a change are marked for matching again. '''
+    place = get_place(place_identifier)
+    if filename:
+        item_ids = place.apply_osm_change(filename)
+    else:
+        item_ids = place.refresh_osm_changes()
+    if item_ids is None:
+        print('OSM tables not loaded, a full refresh is needed')
+        return
+    print('{:,d} items to rematch'.format(len(item_ids)))
+
+def batch_match_place(args):
+    place_id, extract = args
+    place = Place.query.get(place_id)
+    try:
+        place.do_match(debug=False, extract=extract)
+    except Exception:
+        traceback.print_exc()
+        database.session.rollback()
+    state = place.state
+    database.session.remove()
+    return place.display_name, state
+
+@app.cli.command()
+@click.argument('extract_file')
+@click.argument('place_identifiers', nargs=-1)
+@click.option('--within', help='add every place already known inside this one')
+@click.option('--workers', type=int, default=4)
+@click.option('--refresh', is_flag=True, help='match ready places again')
+@click.option('--skip-import', is_flag=True, help='reuse the loaded extract')
+@click.option('--keep-extract', is_flag=True, help="don't drop the extract tables")
+def batch_match(extract_file, place_identifiers, within, workers, refresh,
+                skip_import, keep_extract):
+    ''' Match many places against a local .osm.pbf extract, imported once,
+        without using Overpass. Places can be bigger than PLACE_MAX_AREA. '''
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    identifiers = list(place_identifiers) + ([within] if within else [])
+    found = {i: lookup_place(i) for i in identifiers}
+    unknown = [i for i, place in found.items() if place is None]
+    if unknown:
+        print('unknown places:', ', '.join(unknown))
+        return
+
+    places = [found[i] for i in place_identifiers]
+    if within:
+        outer = found[within]
+        outer_geom = cast(outer.geom, Geometry)
+        q = Place.query.filter(Place.osm_type != 'node',
+                               Place.place_id != outer.place_id,
+                               func.ST_Covers(outer_geom, cast(Place.geom, Geometry)))
+        places += q.all()
+    if not places:
+        print('no places to match')
+        return
+
+    if not skip_import:
+        print('importing', extract_file)
+        if not import_extract(extract_file):
+            print('osm2pgsql failed')
+            return
+
+    covered = []
+    for place in places:
+        if place.extract_covers(extract_prefix):
+            covered.append(place)
+        else:
+            print('not in extract, skipping', place.display_name)
+    places = covered
+
+    for place in places:
+        if refresh and place.state == 'ready':
+            place.reset_all_items_to_not_done()
+            place.state = 'refresh'
+    database.session.commit()
+
+    loaded = datetime.utcfromtimestamp(os.path.getmtime(extract_file))
+    extract = {'prefix': extract_prefix, 'loaded': loaded}
+    jobs = []
+    for place in places:
+        if place.state == 'ready' or place.is_point:
+            print('skipping', place.display_name)
+            continue
+        jobs.append((place.place_id, extract))
+
+    # worker processes must open their own database connections
+    database.session.remove()
+    database.session.bind.dispose()
+
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        for name, state in pool.imap_unordered(batch_match_place, jobs):
+            print('{:12s} {}'.format(state or 'error', name))
+
+    if not keep_extract:
+        for t in osm_tables:
+            database.session.execute(f'drop table if exists {extract_prefix}_{t}')
+        database.session.commit()
@@ -59,5 +59,17 @@ group by place.place_id, place.added, display_name, state, size order by size de
 
     return engine.execute(text(sql_big_polygon_tables))
 
+def get_place_table_sizes():
+    ''' Disk space used by the osm_{place_id}_* tables of each place,
+        including indexes. '''
+    sql = r'''
+select cast(substring(relname from '^osm_(\d+)_') as bigint) as place_id,
+       sum(pg_total_relation_size(C.oid)) as size
+from pg_class C
+where relkind = 'r' and relname ~ '^osm_\d+_'
+group by 1'''
+
+    return session.bind.execute(text(sql))
+
 def now_utc():
     return func.timezone('utc', func.now())
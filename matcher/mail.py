@@ -40,7 +40,9 @@ def get_area(place):
             if place.area
             else 'n/a')
 
-def error_mail(subject, data, r, via_web=True):
+def error_mail(subject, data, r, via_web=True, reply=None):
+    if reply is None:
+        reply = r.text
     body = '''
 remote URL: {r.url}
 status code: {r.status_code}
@@ -52,8 +54,8 @@ status code: {r.status_code}
 content-type: {r.headers[content-type]}
 
 reply:
-{r.text}
-'''.format(r=r, data=data)
+{reply}
+'''.format(r=r, data=data, reply=reply)
 
     if not has_request_context():
         via_web = False
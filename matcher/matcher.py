@@ -11,6 +11,8 @@ patterns = {}
 entity_types = {}
 default_max_dist = 4
 extract_name_good_enough = True
+# bump when a change to the matcher means every item should be matched again
+matcher_version = 1
 
 re_farmhouse = re.compile('^(.*) farm ?house$', re.I)
 
@@ -163,11 +165,33 @@ def hstore_query(tags):
 
     return ' or\n '.join(cond)
 
+class SharedTables:
+    ''' OSM objects of one place in the shared osm_point, osm_line and
+        osm_polygon tables, osm_place_object lists which objects are in
+        which place. '''
+
+    def __init__(self, place_id):
+        self.place_id = place_id
+
+    def table(self, obj_type, alias=None):
+        return (f'(select o.* from osm_{obj_type} o '
+                'join osm_place_object m on m.osm_id = o.osm_id '
+                f"where m.tbl = '{obj_type}' "
+                f'and m.place_id = {self.place_id}) {alias or obj_type}')
+
+def osm_table(source, obj_type, alias=None):
+    ''' SQL for the OSM objects of one type, source is either the prefix of
+        a place's own tables or SharedTables. '''
+    if isinstance(source, SharedTables):
+        return source.table(obj_type, alias)
+    table = f'{source}_{obj_type}'
+    return f'{table} {alias}' if alias else table
+
 def nearby_nodes_sql(item, prefix, max_dist=10, limit=50):
     point = f"ST_TRANSFORM(ST_GeomFromEWKT('{item.ewkt}'), 3857)"
     sql = (f"select 'point', osm_id, name, tags, "
            f'ST_Distance({point}, way) as dist '
-           f'from {prefix}_point '
+           f"from {osm_table(prefix, 'point')} "
            f'where ST_DWithin({point}, way, {max_dist})')
     return sql
 
@@ -186,7 +210,7 @@ def item_match_sql(item, prefix, ignore_tags=None, limit=50):
     for obj_type in 'point', 'line', 'polygon':
         obj_sql = (f"select '{obj_type}', osm_id, name, tags, "
                    f'ST_Distance({point}, way) as dist '
-                   f'from {prefix}_{obj_type} '
+                   f'from {osm_table(prefix, obj_type)} '
                    f'where ST_DWithin({point}, way, {item_max_dist} * 1000)')
         sql_list.append(obj_sql)
     sql = ('select * from (' + ' union '.join(sql_list) +
@@ -562,7 +586,7 @@ def find_item_matches(cur, item, prefix, debug=False):
             continue  # NHLE items normally have quite precise coordinates
 
         sql = (f'select ST_AsText(ST_Transform(way, 4326)) '
-               f'from {prefix}_{src_type} '
+               f'from {osm_table(prefix, src_type)} '
                f'where osm_id={src_id}')
         cur.execute(sql)
         row = cur.fetchone()
@@ -746,7 +770,7 @@ def run_individual_match(place, item):
     conn = database.session.bind.raw_connection()
     cur = conn.cursor()
 
-    candidates = find_item_matches(cur, item, place.prefix, debug=False)
+    candidates = find_item_matches(cur, item, place.osm_source, debug=False)
     conn.close()
 
     return candidates
@@ -794,13 +818,13 @@ def all_in_one(item, conn, prefix):
         if not id_list:
             continue
         obj_sql = ('select \'{}\' as t, osm_id, way '
-                   'from {}_{} '
-                   'where osm_id in ({})').format(table, table, prefix, id_list)
+                   'from {} '
+                   'where osm_id in ({})').format(table, osm_table(prefix, table), id_list)
         sql_list.append(obj_sql)
 
     if not sql_list:
         return
-    sql = 'select ST_Within(a.way, b.way) from (' + ' union '.join(sql_list) + ') a, {}_polygon b where b.osm_id={}'.format(prefix, biggest)
+    sql = 'select ST_Within(a.way, b.way) from (' + ' union '.join(sql_list) + ') a, {} where b.osm_id={}'.format(osm_table(prefix, 'polygon', 'b'), biggest)
     cur.execute(sql)
     if all(row[0] for row in cur.fetchall()):
         return biggest
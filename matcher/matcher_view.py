@@ -47,6 +47,7 @@ def matcher_progress(osm_type, osm_id):
     if place.too_big:
         return render_template('too_big.html', place=place)
 
+    place.touch()
     is_refresh = place.state == 'refresh'
 
     announce_matcher_progress(place)
@@ -17,6 +17,8 @@ from . import wikidata, matcher, match, wikipedia, country_units, utils, mail
 from .overpass import oql_from_tag
 from .utils import capfirst
 from collections import defaultdict
+import hashlib
+import json
 
 Base = declarative_base()
 Base.query = session.query_property()
@@ -61,10 +63,62 @@ class IsA(Base):
     entity = Column(postgresql.JSON)
     qid = column_property('Q' + cast(item_id, String))
     label = Column(String)
+    graph = Column(postgresql.JSON)  # node in the local subclass-of graph
 
     def url(self):
         return f'https://www.wikidata.org/wiki/Q{self.item_id}'
 
+    def graph_node(self):
+        node = {
+            'qid': self.qid,
+            'label': self.graph['label'],
+            'children': set(self.graph['children']),
+        }
+        if self.graph.get('country'):
+            node['country'] = self.graph['country']
+        return node
+
+    @classmethod
+    def type_graph(cls, types):
+        ''' Subclass-of graph above the given types, built from the local
+            copy. Types that haven't been seen before are looked up on
+            Wikidata and saved for next time. '''
+        graph = {}
+        todo = set(types)
+        while todo:
+            ids = [int(qid[1:]) for qid in todo]
+            found = {isa.qid: isa
+                     for isa in cls.query.filter(cls.item_id.in_(ids))}
+            unknown = [qid for qid in todo
+                       if qid not in found or not found[qid].graph]
+
+            new_nodes = {}
+            for cur in utils.chunk(unknown, 100):
+                new_nodes.update(wikidata.get_type_graph(cur))
+            for qid, node in new_nodes.items():
+                isa = found.get(qid) or cls.query.get(int(qid[1:]))
+                if not isa:
+                    isa = cls(item_id=int(qid[1:]), label=node['label'])
+                    session.add(isa)
+                isa.graph = {
+                    'label': node['label'],
+                    'children': sorted(node['children']),
+                    'country': node.get('country'),
+                }
+                found[qid] = isa
+
+            next_todo = set()
+            for qid in todo:
+                isa = found.get(qid)
+                if not isa or not isa.graph:
+                    continue
+                graph[qid] = isa.graph_node()
+                if 'country' in graph[qid]:
+                    next_todo |= graph[qid]['children']
+            todo = next_todo - graph.keys()
+
+        return graph
+
     def entity_label(self, lang='en'):
         labels = self.entity['labels']
         if lang in labels:
@@ -109,6 +163,7 @@ class Extract(Base):
                      autoincrement=False)
     site = Column(String, primary_key=True)
     extract = Column(String, nullable=False)
+    revid = Column(BigInteger)  # page revision the extract was taken from
 
     def __init__(self, site, extract):
         self.site = site
@@ -120,7 +175,7 @@ class Item(Base):
     item_id = Column(Integer, primary_key=True, autoincrement=False)
     location = Column(Geography('POINT', spatial_index=True), nullable=False)
     enwiki = Column(String, index=True)
-    entity = Column(postgresql.JSON)
+    entity = Column(postgresql.JSONB)  # trimmed, see wikidata.trim_entity
     categories = Column(postgresql.ARRAY(String))
     old_tags = Column(postgresql.ARRAY(String))
     qid = column_property('Q' + cast(item_id, String))
@@ -305,31 +360,9 @@ https://www.wikidata.org/wiki/{self.qid}
         if not self.entity:
             return {}
 
-        property_map = [
-            ('P238', ['iata'], 'IATA airport code'),
-            ('P239', ['icao'], 'ICAO airport code'),
-            ('P240', ['faa', 'ref'], 'FAA airport code'),
-            # ('P281', ['addr:postcode', 'postal_code'], 'postal code'),
-            ('P296', ['ref', 'ref:train', 'railway:ref'], 'station code'),
-            ('P300', ['ISO3166-2'], 'ISO 3166-2 code'),
-            ('P649', ['ref:nrhp'], 'NRHP reference number'),
-            ('P722', ['uic_ref'], 'UIC station code'),
-            ('P836', ['ref:gss'], 'UK Government Statistical Service code'),
-            ('P856', ['website', 'contact:website', 'url'], 'website'),
-            ('P882', ['nist:fips_code'], 'FIPS 6-4 (US counties)'),
-            ('P883', ['state_code', 'ref', 'nist:fips_code'], 'FIPS 5-2 (code for US states)'),
-            # A UIC id can be a IBNR, but not every IBNR is an UIC id
-            ('P954', ['uic_ref'], 'IBNR ID'),
-            ('P1216', ['HE_ref'], 'National Heritage List for England number'),
-            ('P2253', ['ref:edubase'], 'EDUBase URN'),
-            ('P2815', ['esr:user', 'ref', 'ref:train'], 'ESR station code'),
-            ('P3562', ['seamark:light:reference'], 'Admiralty number'),
-            ('P4755', ['ref', 'ref:train', 'ref:crs'], 'UK railway station code'),
-            ('P4803', ['ref', 'ref:train'], 'Amtrak station code'),
-        ]
 
         tags = defaultdict(list)
-        for claim, osm_keys, label in property_map:
+        for claim, osm_keys, label in wikidata.property_map:
             values = [i['mainsnak']['datavalue']['value']
                       for i in self.entity['claims'].get(claim, [])
                       if 'datavalue' in i['mainsnak']]
@@ -355,6 +388,18 @@ https://www.wikidata.org/wiki/{self.qid}
     def refresh_extract_names(self):
         self.extract_names = wikipedia.html_names(self.extract)
 
+    def match_fingerprint(self):
+        ''' Hash of the inputs to the matcher, if it is unchanged there is no
+            need to match the item again. '''
+        inputs = [
+            matcher.matcher_version,
+            (self.entity or {}).get('lastrevid'),
+            sorted(self.tags),
+            sorted(self.categories or []),
+            sorted(self.extract_names or []),
+        ]
+        return hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()
+
     def get_oql(self):
         lat, lon = session.query(func.ST_Y(self.location), func.ST_X(self.location)).one()
         union = []
@@ -587,6 +632,7 @@ class PlaceItem(Base):
     osm_id = Column(BigInteger, primary_key=True)
     place_id = Column(BigInteger)  # unused, replaced by osm_type & osm_id
     done = Column(Boolean)
+    fingerprint = Column(String)  # Item.match_fingerprint() when matched
 
     __table_args__ = (
         ForeignKeyConstraint(
@@ -832,6 +878,16 @@ class Category(Base):
     name = Column(String, primary_key=True)
     page_count = Column(Integer)
 
+class PageCategories(Base):
+    ''' Categories of an enwiki article, cached by wikipedia.page_category_iter.
+        categories is NULL for redirects and missing pages. '''
+    __tablename__ = 'page_categories'
+
+    title = Column(String, primary_key=True)
+    categories = Column(postgresql.ARRAY(String))
+    revid = Column(BigInteger)
+    fetched = Column(DateTime, default=now_utc(), nullable=False)
+
 class Changeset(Base):
     __tablename__ = 'changeset'
     id = Column(BigInteger, primary_key=True)
@@ -1,27 +1,50 @@
+buffer_size = 64 * 1024
+
+def frame(to_send):
+    data = to_send.encode('utf-8')
+    return b'%d:%s,' % (len(data), data)
+
 def write(sock, to_send):
-    sock.sendall(b'%d' % len(to_send))
-    sock.sendall(b':')
-    sock.sendall(to_send.encode('utf-8'))
-    sock.sendall(b',')
+    sock.sendall(frame(to_send))
+
+class Reader:
+    ''' Read netstrings from a socket, keeps any bytes received after the end
+        of one message for the next call. '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+        self.chunk = bytearray(buffer_size)
+
+    def fill(self):
+        ''' Receive more data, returns False at the end of the stream. '''
+        view = memoryview(self.chunk)
+        n = self.sock.recv_into(view)
+        if n == 0:
+            return False
+        self.buf += view[:n]
+        return True
+
+    def read(self):
+        while b':' not in self.buf:
+            assert self.buf.isdigit() or not self.buf
+            if not self.fill():
+                assert not self.buf
+                return
+        colon = self.buf.index(b':')
+        length = self.buf[:colon]
+        assert length.isdigit()
+        end = colon + 1 + int(length)
+
+        while len(self.buf) <= end:
+            if not self.fill():
+                raise EOFError('connection closed in the middle of a netstring')
+        assert self.buf[end:end + 1] == b','
+
+        data = bytes(self.buf[colon + 1:end])
+        del self.buf[:end + 1]
+        return data.decode('utf-8')
 
 def read(sock):
-    char = sock.recv(1)
-    if char == b'':
-        return
-    buf = b''
-    while char != b':':
-        if not char.isdigit():
-            print('char:', repr(char))
-        assert char.isdigit()
-        buf += char
-        char = sock.recv(1)
-    byte_len = int(buf.decode('ASCII'))
-    buf = b''
-    while len(buf) < byte_len:
-        buf += sock.recv(byte_len - len(buf))
-    assert len(buf) == byte_len
-    char = sock.recv(1)
-    while char == b'':
-        char = sock.recv(1)
-    assert char == b','
-    return buf.decode('utf-8')
+    ''' Read a single message, only for connections that carry one reply. '''
+    return Reader(sock).read()
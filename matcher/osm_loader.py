@@ -0,0 +1,389 @@
+''' Load Overpass XML into the tables the matcher searches, without osm2pgsql.
+
+The tables match the layout osm2pgsql gives us with --hstore-all: osm_id,
+name, tags and way in EPSG:3857, relations have negative IDs and polygons
+have their area in the way_area tag. '''
+
+from lxml import etree
+from . import utils
+import math
+
+earth_radius = 6378137  # metres, as used by EPSG:3857
+max_lat = 85.0511287798
+
+# closed ways with one of these keys are areas, following osm2pgsql's style
+polygon_keys = {'aeroway', 'amenity', 'area:highway', 'boundary', 'building',
+                'building:part', 'harbour', 'historic', 'landuse', 'leisure',
+                'man_made', 'military', 'natural', 'office', 'place', 'power',
+                'public_transport', 'shop', 'sport', 'tourism', 'water',
+                'waterway', 'wetland'}
+
+# tags osm2pgsql ignores when deciding if an object is worth keeping
+ignore_keys = {'created_by', 'source', 'odbl', 'note:postcode'}
+
+area_relation_types = {'multipolygon', 'boundary'}
+line_relation_types = {'route'}
+
+copy_sql = 'copy {} (tbl, osm_id, tags, way) from stdin'
+
+def mercator(lon, lat):
+    lat = max(min(lat, max_lat), -max_lat)
+    x = math.radians(lon) * earth_radius
+    y = math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * earth_radius
+    return x, y
+
+def coords_text(coords):
+    return ','.join('%.2f %.2f' % xy for xy in coords)
+
+def is_area(tags):
+    if tags.get('area') == 'no':
+        return False
+    return tags.get('area') == 'yes' or any(k in polygon_keys for k in tags)
+
+def interesting(tags):
+    return any(k not in ignore_keys for k in tags)
+
+def get_tags(elem):
+    return {tag.get('k'): tag.get('v') for tag in elem.iterfind('tag')}
+
+def hstore_quote(s):
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def hstore(tags):
+    return ', '.join(hstore_quote(k) + '=>' + hstore_quote(v)
+                     for k, v in tags.items())
+
+def copy_escape(s):
+    return (s.replace('\\', '\\\\').replace('\t', '\\t')
+             .replace('\n', '\\n').replace('\r', '\\r'))
+
+def iter_elements(filename):
+    ''' Stream nodes, ways and relations, freeing each one once read. '''
+    tags = ('node', 'way', 'relation')
+    with utils.open_data(filename) as f:
+        for event, elem in etree.iterparse(f, tag=tags):
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+def way_coords(elem, nodes):
+    ''' Coordinates of a way, from the nodes read so far or from the inline
+        geometry Overpass adds with "out geom". '''
+    coords = []
+    for nd in elem.iterfind('nd'):
+        if nd.get('lat') is not None:
+            coords.append(mercator(float(nd.get('lon')), float(nd.get('lat'))))
+            continue
+        ref = int(nd.get('ref'))
+        if ref in nodes:
+            coords.append(nodes[ref])
+    return coords
+
+def member_lines(elem, ways):
+    lines = []
+    for m in elem.iterfind('member'):
+        if m.get('type') != 'way':
+            continue
+        if m.find('nd') is not None:
+            coords = way_coords(m, {})
+        else:
+            coords = ways.get(int(m.get('ref')))
+        if coords and len(coords) > 1:
+            lines.append(coords)
+    return lines
+
+def way_row(osm_id, tags, coords):
+    closed = len(coords) > 3 and coords[0] == coords[-1]
+    if closed and is_area(tags):
+        return ('polygon', osm_id, tags,
+                'POLYGON((' + coords_text(coords) + '))')
+    return ('line', osm_id, tags, 'LINESTRING(' + coords_text(coords) + ')')
+
+def relation_table(tags):
+    rel_type = tags.get('type')
+    if rel_type in area_relation_types:
+        return 'multipolygon'
+    if rel_type in line_relation_types:
+        return 'line'
+
+def relation_row(osm_id, tags, lines):
+    wkt = ('MULTILINESTRING(' +
+           ','.join('(' + coords_text(line) + ')' for line in lines) + ')')
+    return (relation_table(tags), -osm_id, tags, wkt)
+
+def parse(filename):
+    ''' Yield (table, osm_id, tags, ewkt) rows. Multipolygon relations are
+        yielded with table 'multipolygon' as their member linework, the
+        polygons are built by PostGIS. '''
+    nodes = {}
+    ways = {}
+    for elem in iter_elements(filename):
+        osm_id = int(elem.get('id'))
+        tags = get_tags(elem)
+
+        if elem.tag == 'node':
+            xy = mercator(float(elem.get('lon')), float(elem.get('lat')))
+            nodes[osm_id] = xy
+            if interesting(tags):
+                yield ('point', osm_id, tags, 'POINT(%.2f %.2f)' % xy)
+            continue
+
+        if elem.tag == 'way':
+            coords = way_coords(elem, nodes)
+            if len(coords) < 2:
+                continue
+            ways[osm_id] = coords
+            if interesting(tags):
+                yield way_row(osm_id, tags, coords)
+            continue
+
+        if not relation_table(tags):
+            continue
+        lines = member_lines(elem, ways)
+        if lines:
+            yield relation_row(osm_id, tags, lines)
+
+def copy_lines(rows):
+    for table, osm_id, tags, wkt in rows:
+        fields = [table, str(osm_id), copy_escape(hstore(tags)),
+                  'SRID=3857;' + wkt]
+        yield '\t'.join(fields) + '\n'
+
+class LineReader:
+    ''' File-like object for COPY, reads from an iterator of lines. '''
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buf += line
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+def create_staging(cur, prefix):
+    ''' Start a load, rows are collected in {prefix}_load. '''
+    for t in 'load', 'point', 'line', 'polygon':
+        cur.execute(f'drop table if exists {prefix}_{t}')
+    cur.execute(f'create unlogged table {prefix}_load '
+                '(tbl text, osm_id bigint, tags hstore, way geometry)')
+
+def copy_file(cur, prefix, filename):
+    ''' Append the objects in an OSM XML file to the staging table. '''
+    cur.copy_expert(copy_sql.format(prefix + '_load'),
+                    LineReader(copy_lines(parse(filename))))
+
+def unique_rows(staging, *tables):
+    in_list = ', '.join(f"'{t}'" for t in tables)
+    return ('select distinct on (osm_id) osm_id, tags, way '
+            f'from {staging} where tbl in ({in_list}) '
+            'order by osm_id, ST_NPoints(way) desc')
+
+def build_tables(cur, prefix):
+    ''' Create {prefix}_point, _line and _polygon from the staging table.
+        Objects in more than one chunk are loaded once, keeping the copy with
+        the most complete geometry. '''
+    staging = prefix + '_load'
+    cur.execute(f'create table {prefix}_point as '
+                "select osm_id, tags->'name' as name, tags, way "
+                f"from ({unique_rows(staging, 'point')}) a")
+    cur.execute(f'create table {prefix}_line as '
+                "select osm_id, tags->'name' as name, tags, way "
+                f"from ({unique_rows(staging, 'line')}) a")
+    # osm2pgsql puts way_area in tags, the matcher reads it from there
+    cur.execute(f'create table {prefix}_polygon as '
+                "select osm_id, tags->'name' as name, "
+                "tags || hstore('way_area', ST_Area(way)::real::text) as tags, "
+                'way from ('
+                'select osm_id, tags, ST_Multi(case '
+                'when osm_id < 0 then ST_BuildArea(way) '
+                'else ST_MakeValid(way) end) as way '
+                f"from ({unique_rows(staging, 'polygon', 'multipolygon')}) b"
+                ') a where way is not null')
+    cur.execute(f'drop table {staging}')
+
+    for t in 'point', 'line', 'polygon':
+        table = f'{prefix}_{t}'
+        cur.execute(f'create index {table}_index on {table} using gist (way)')
+        cur.execute(f'create index {table}_tags_index '
+                    f'on {table} using gin (tags)')
+
+def load(cur, prefix, filename):
+    ''' Create {prefix}_point, _line and _polygon from an OSM XML file. '''
+    create_staging(cur, prefix)
+    copy_file(cur, prefix, filename)
+    build_tables(cur, prefix)
+
+def create_shared_tables(cur):
+    for t in 'point', 'line', 'polygon':
+        cur.execute(f'create table if not exists osm_{t} '
+                    '(osm_id bigint primary key, name text, tags hstore, '
+                    'way geometry)')
+        cur.execute(f'create index if not exists osm_{t}_index '
+                    f'on osm_{t} using gist (way)')
+        cur.execute(f'create index if not exists osm_{t}_tags_index '
+                    f'on osm_{t} using gin (tags)')
+    cur.execute('create table if not exists osm_place_object '
+                '(place_id bigint, tbl text, osm_id bigint, '
+                'primary key (place_id, tbl, osm_id))')
+    cur.execute('create index if not exists osm_place_object_object_index '
+                'on osm_place_object (tbl, osm_id)')
+
+def move_to_shared(cur, prefix, place_id):
+    ''' Merge a place's own tables into the shared tables and drop them.
+        Objects already stored for another place are updated. '''
+    create_shared_tables(cur)
+    cur.execute('delete from osm_place_object where place_id = %s',
+                [place_id])
+    for t in 'point', 'line', 'polygon':
+        table = f'{prefix}_{t}'
+        cur.execute(f'insert into osm_{t} (osm_id, name, tags, way) '
+                    'select distinct on (osm_id) osm_id, name, tags, way '
+                    f'from {table} order by osm_id '
+                    'on conflict (osm_id) do update set name = excluded.name, '
+                    'tags = excluded.tags, way = excluded.way')
+        cur.execute('insert into osm_place_object (place_id, tbl, osm_id) '
+                    f"select distinct %s, '{t}', osm_id from {table} "
+                    'on conflict do nothing', [place_id])
+        cur.execute(f'drop table {table}')
+
+def copy_shared(cur, parent_id, place_id, geom):
+    ''' Add the parent's objects that intersect geom to place_id. '''
+    for t in 'point', 'line', 'polygon':
+        cur.execute('insert into osm_place_object (place_id, tbl, osm_id) '
+                    f"select %s, '{t}', o.osm_id from osm_{t} o "
+                    'join osm_place_object m on m.osm_id = o.osm_id '
+                    f"where m.tbl = '{t}' and m.place_id = %s "
+                    f'and ST_Intersects(o.way, {geom}) '
+                    'on conflict do nothing', [place_id, parent_id])
+
+def remove_shared(cur, place_id):
+    ''' Remove a place from the shared tables, objects no other place uses
+        are deleted. '''
+    for t in 'point', 'line', 'polygon':
+        cur.execute('with gone as (delete from osm_place_object '
+                    f"where place_id = %s and tbl = '{t}' returning osm_id) "
+                    f'delete from osm_{t} o using gone '
+                    'where o.osm_id = gone.osm_id and not exists ('
+                    'select 1 from osm_place_object m '
+                    f"where m.tbl = '{t}' and m.osm_id = o.osm_id "
+                    'and m.place_id != %s)', [place_id, place_id])
+
+def change_elements(root):
+    ''' Yield (action, element) from an osmChange file or an Overpass
+        augmented diff, for a delete the element is the old version. '''
+    if root.tag == 'osmChange':
+        for block in root:
+            for elem in block:
+                yield block.tag, elem
+        return
+
+    for action in root.iterfind('action'):
+        action_type = action.get('type')
+        if action_type == 'create':
+            yield action_type, action[0]
+        elif action_type == 'delete':
+            yield action_type, action.find('old')[0]
+        else:
+            yield action_type, action.find('new')[0]
+
+def parse_change(filename):
+    ''' Yield (action, osm_type, osm_id, tags, row) for each change, row is
+        None if there is no geometry for the new version. '''
+    with utils.open_data(filename) as f:
+        root = etree.parse(f).getroot()
+
+    nodes = {}
+    ways = {}
+    for action, elem in change_elements(root):
+        osm_type = elem.tag
+        osm_id = int(elem.get('id'))
+        tags = get_tags(elem)
+        row = None
+
+        if osm_type == 'node' and elem.get('lat') is not None:
+            xy = mercator(float(elem.get('lon')), float(elem.get('lat')))
+            nodes[osm_id] = xy
+            row = ('point', osm_id, tags, 'POINT(%.2f %.2f)' % xy)
+        elif osm_type == 'way':
+            coords = way_coords(elem, nodes)
+            if len(coords) > 1:
+                ways[osm_id] = coords
+                row = way_row(osm_id, tags, coords)
+        elif osm_type == 'relation' and relation_table(tags):
+            lines = member_lines(elem, ways)
+            if lines:
+                row = relation_row(osm_id, tags, lines)
+
+        yield action, osm_type, osm_id, tags, row
+
+def apply_change(cur, prefix, changes, place_id=None):
+    ''' Apply changes to {prefix}_point, _line and _polygon. The old and new
+        geometry of every changed object goes in the temp table osm_changed.
+        Pass place_id when prefix is the shared tables. '''
+    cur.execute('create temp table osm_changed (way geometry) on commit drop')
+    changed_sql = 'insert into osm_changed select way from affected'
+    count = 0
+    for action, osm_type, osm_id, tags, row in changes:
+        count += 1
+        tables = ['point'] if osm_type == 'node' else ['line', 'polygon']
+        db_id = -osm_id if osm_type == 'relation' else osm_id
+
+        if action != 'delete' and interesting(tags) and row is None:
+            # geometry not in the change file, only update the tags
+            for t in tables:
+                cur.execute(f'with affected as (update {prefix}_{t} '
+                            'set tags = %s::hstore || '
+                            "slice(tags, array['way_area']), name = %s "
+                            'where osm_id = %s returning way) ' + changed_sql,
+                            [hstore(tags), tags.get('name'), db_id])
+            continue
+
+        gone = action == 'delete' or not interesting(tags) or row is None
+        for t in tables:
+            cur.execute(f'with affected as (delete from {prefix}_{t} '
+                        'where osm_id = %s returning way) ' + changed_sql,
+                        [db_id])
+            if place_id is not None and gone:
+                # the object is gone for every place that contains it
+                cur.execute('delete from osm_place_object '
+                            'where tbl = %s and osm_id = %s', [t, db_id])
+
+        if gone:
+            continue
+
+        table, db_id, tags, wkt = row
+        geom = "ST_GeomFromEWKT('SRID=3857;' || %s)"
+        if table == 'multipolygon':
+            table, geom = 'polygon', f'ST_Multi(ST_BuildArea({geom}))'
+        elif table == 'polygon':
+            geom = f'ST_Multi(ST_MakeValid({geom}))'
+        new_tags = '%s::hstore'
+        if table == 'polygon':
+            new_tags += " || hstore('way_area', ST_Area(g.way)::real::text)"
+        cur.execute(f'with affected as (insert into {prefix}_{table} '
+                    '(osm_id, name, tags, way) '
+                    f'select %s, %s, {new_tags}, g.way '
+                    f'from (select {geom} as way) g returning way) '
+                    + changed_sql,
+                    [db_id, tags.get('name'), hstore(tags), wkt])
+        if place_id is not None:
+            # other places keep the object, it may have moved table
+            cur.execute('insert into osm_place_object (place_id, tbl, osm_id) '
+                        'select place_id, %s, osm_id from osm_place_object '
+                        'where osm_id = %s and tbl = any(%s) '
+                        'on conflict do nothing', [table, db_id, tables])
+            cur.execute('delete from osm_place_object '
+                        'where osm_id = %s and tbl = any(%s) and tbl != %s',
+                        [db_id, tables, table])
+            cur.execute('insert into osm_place_object (place_id, tbl, osm_id) '
+                        'values (%s, %s, %s) on conflict do nothing',
+                        [place_id, table, db_id])
+    return count
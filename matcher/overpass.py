@@ -1,16 +1,32 @@
 #!/usr/bin/python3
 import re
 import requests
+import os
 import os.path
 import json
+import shutil
+import tempfile
+import hashlib
+import gzip
 import simplejson
 from flask import current_app
-from time import sleep
-from . import user_agent_headers, mail
+from time import sleep, time
+from . import user_agent_headers, mail, utils
 from collections import defaultdict
 
 re_slot_available = re.compile(r'^Slot available after: ([^,]+), in (-?\d+) seconds?\.$')
-re_available_now = re.compile(r'^\d+ slots available now.$')
+re_available_now = re.compile(r'^(\d+) slots? available now.$')
+re_timeout = re.compile(r'\[timeout:\d+\]')
+re_recurse_out = re.compile(r'\(\._;>;\);\s*out[^;]*;$')
+re_quoted = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')')
+
+download_chunk_size = 256 * 1024
+
+# responses are cached in OVERPASS_DIR/cache, keyed by a hash of the query
+default_cache_ttl = 24 * 60 * 60  # seconds
+default_cache_max_size = 10 * 1024 ** 3  # bytes
+evict_interval = 10 * 60  # seconds between checks of the cache size
+last_evict = 0
 
 name_only_tag = {'area=yes', 'type=tunnel', 'leisure=park', 'leisure=garden',
         'site=aerodome', 'amenity=hospital', 'boundary', 'amenity=pub',
@@ -30,13 +46,16 @@ class Timeout(Exception):
     pass
 
 class OverpassError(Exception):
-    def __init__(self, r):
+    def __init__(self, r, reply=None, error=None):
         self.r = r
+        self.reply = reply
+        self.error = error
 
-def run_query(oql, error_on_rate_limit=True):
+def run_query(oql, error_on_rate_limit=True, stream=False):
     r = requests.post(endpoint(),
                       data=oql.encode('utf-8'),
-                      headers=user_agent_headers())
+                      headers=user_agent_headers(),
+                      stream=stream)
 
     if (error_on_rate_limit and
             r.status_code == 429 and
@@ -46,6 +65,90 @@ def run_query(oql, error_on_rate_limit=True):
 
     return r
 
+def adiff_oql(oql, since):
+    ''' Turn the query for a place into one for an augmented diff of the
+        changes since a date, with geometry included. '''
+    date = since.strftime('%Y-%m-%dT%H:%M:%SZ')
+    oql = oql.replace('[out:xml]', f'[out:xml][adiff:"{date}"]', 1)
+    return re_recurse_out.sub('out geom;', oql.strip())
+
+def normalize_oql(oql):
+    ''' Collapse whitespace outside of quoted strings and drop the timeout
+        setting, neither changes the result of a query. '''
+    parts = re_quoted.split(re_timeout.sub('', oql))
+    parts[::2] = [' '.join(part.split()) for part in parts[::2]]
+    return ''.join(parts).strip()
+
+def cache_dir():
+    return os.path.join(current_app.config['OVERPASS_DIR'], 'cache')
+
+def cache_filename(oql):
+    key = endpoint() + '\n' + normalize_oql(oql)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    ext = 'json' if '[out:json]' in oql else 'xml'
+    return os.path.join(cache_dir(), digest[:2], digest + '.' + ext)
+
+def cache_ttl():
+    return current_app.config.get('OVERPASS_CACHE_TTL', default_cache_ttl)
+
+def cache_lookup(oql):
+    ''' Return the filename of a cached response if one is fresh enough.
+        The access time is updated for LRU eviction. '''
+    filename = cache_filename(oql)
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return
+    if time() - st.st_mtime > cache_ttl():
+        return
+    os.utime(filename, (time(), st.st_mtime))
+    return filename
+
+def evict_cache(force=False):
+    ''' Remove expired responses, then the least recently used ones until the
+        cache is below OVERPASS_CACHE_MAX_SIZE. '''
+    global last_evict
+    if not force and time() - last_evict < evict_interval:
+        return
+    last_evict = time()
+    max_size = current_app.config.get('OVERPASS_CACHE_MAX_SIZE',
+                                      default_cache_max_size)
+    ttl = cache_ttl()
+
+    entries = []
+    for root, dirs, files in os.walk(cache_dir()):
+        for name in files:
+            if name.endswith(('.part', '.tmp')):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if last_evict - st.st_mtime > ttl:
+                os.remove(path)
+                continue
+            entries.append((st.st_atime, st.st_size, path))
+
+    total = sum(size for atime, size, path in entries)
+    for atime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        os.remove(path)
+        total -= size
+
+def copy_from_cache(cached, filename):
+    ''' Hard link a cached response to filename, copy across filesystems.
+        Either way filename keeps the time of the download. '''
+    tmp = filename + '.part'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(cached, tmp)
+    except OSError:
+        shutil.copy2(cached, tmp)
+    os.replace(tmp, filename)
+
 def get_elements(oql):
     return run_query(oql).json()['elements']
 
@@ -258,12 +361,14 @@ def parse_status(r):
         slots.append(int(m.group(2)))
 
     next_line = lines[i]
-    assert (re_available_now.match(next_line) or
+    m = re_available_now.match(next_line)
+    assert (m or
             next_line == 'Currently running queries (pid, space limit, time limit, start time):')
 
     return {
         'rate_limit': int(lines[2][len(limit):]),
         'slots': slots,
+        'available': int(m.group(1)) if m else 0,
         'running': len(lines) - (i + 1)
     }
 
@@ -284,63 +389,82 @@ def wait_for_slot(status=None, url=None):
         print('waiting {} seconds'.format(slots[0]))
         sleep(slots[0] + 1)
 
-def item_filename(wikidata_id, radius):
-    assert wikidata_id[0] == 'Q'
-    overpass_dir = current_app.config['OVERPASS_DIR']
-    return os.path.join(overpass_dir, '{}_{}.json'.format(wikidata_id, radius))
-
-def existing_item_filename(wikidata_id):
-    assert wikidata_id[0] == 'Q'
-    overpass_dir = current_app.config['OVERPASS_DIR']
-    return os.path.join(overpass_dir, '{}_existing.json'.format(wikidata_id))
-
-def item_query(oql, wikidata_id, radius=1000, refresh=False):
-    filename = item_filename(wikidata_id, radius)
-
-    if not refresh and os.path.exists(filename):
-        return json.load(open(filename))['elements']
-
-    r = run_query(oql)
-
-    if len(r.content) < 2000 and b'<title>504 Gateway' in r.content:
-        mail.error_mail('item query: overpass 504 gateway timeout', oql, r)
+def xml_complete(filename):
+    ''' Check the end of an XML file from Overpass, a truncated download or
+        a query that hit a runtime error doesn't end with a clean </osm>.
+        Compressed files are only renamed into place after that check, so
+        they are trusted rather than decompressed on every call. '''
+    try:
+        if utils.is_gzip(filename):
+            return True
+        with open(filename, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 1024))
+            tail = f.read()
+    except OSError:
+        return False
+    return tail.rstrip().endswith(b'</osm>') and b'runtime error' not in tail
+
+def save_elements(oql, filename):
+    ''' Stream the JSON response to filename and parse the elements from
+        the saved file, the body is never held in memory as one string. '''
+    r = run_query(oql, stream=True)
+
+    # unique name, another worker might be saving the same query
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(filename),
+                                     suffix='.tmp', delete=False) as out:
+        tmp = out.name
+        try:
+            for data in r.iter_content(chunk_size=utils.json_chunk_size):
+                out.write(data)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    with open(tmp, 'rb') as f:
+        head = f.read(2000)
+    if len(head) < 2000 and b'<title>504 Gateway' in head:
+        os.remove(tmp)
+        reply = head.decode('utf-8', 'replace')
+        mail.error_mail('item query: overpass 504 gateway timeout', oql, r,
+                        reply=reply)
         raise Timeout
 
     try:
-        data = r.json()
-    except simplejson.scanner.JSONDecodeError:
-        mail.error_mail('item overpass query error', oql, r)
+        elements = list(utils.iter_json_array(utils.file_chunks(tmp),
+                                              'elements'))
+    except ValueError:
+        os.remove(tmp)
+        reply = head.decode('utf-8', 'replace')
+        mail.error_mail('item overpass query error', oql, r, reply=reply)
         raise
 
-    json.dump(data, open(filename, 'w'))
-    return data['elements']
+    os.replace(tmp, filename)
+    return elements
 
-def get_existing(wikidata_id, refresh=False):
-    filename = existing_item_filename(wikidata_id)
+def cached_elements(oql, refresh=False):
+    cached = None if refresh else cache_lookup(oql)
+    if cached:
+        return list(utils.iter_json_array(utils.file_chunks(cached),
+                                          'elements'))
+
+    filename = cache_filename(oql)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    elements = save_elements(oql, filename)
+    evict_cache()
+    return elements
 
-    if not refresh and os.path.exists(filename):
-        return json.load(open(filename))['elements']
+def item_query(oql, refresh=False):
+    return cached_elements(oql, refresh=refresh)
 
+def get_existing(wikidata_id, refresh=False):
     oql = '''
 [timeout:300][out:json];
 (node[wikidata={qid}]; way[wikidata={qid}]; rel[wikidata={qid}];);
 out qt center tags;
 '''.format(qid=wikidata_id)
 
-    r = run_query(oql)
-
-    if len(r.content) < 2000 and b'<title>504 Gateway' in r.content:
-        mail.error_mail('item query: overpass 504 gateway timeout', oql, r)
-        raise Timeout
-
-    try:
-        data = r.json()
-    except simplejson.scanner.JSONDecodeError:
-        mail.error_mail('item overpass query error', oql, r)
-        raise
-
-    json.dump(data, open(filename, 'w'))
-    return data['elements']
+    return cached_elements(oql, refresh=refresh)
 
 def get_tags(elements):
     union = {'{}({});\n'.format({'relation': 'rel'}.get(i.osm_type, i.osm_type), i.osm_id)
@@ -354,32 +478,92 @@ out qt tags;
 
     return get_elements(oql)
 
-def run_query_persistent(oql, attempts=3, via_web=True):
+def download_error(head, tail):
+    ''' Look for an error in the first and last few KB of an XML response. '''
+    if b'<title>504 Gateway' in head:
+        return 'timeout'
+    for part in head, tail:
+        if b'<remark> runtime error: Query run out of memory' in part:
+            return 'out of memory'
+        if b'<remark> runtime error:' in part:
+            return 'runtime error'
+    if not tail.rstrip().endswith(b'</osm>'):
+        return 'incomplete'
+
+def run_query_to_file(oql, filename, refresh=False):
+    ''' Save the result of an [out:xml] query to filename, from the cache if
+        possible. A download is streamed into a temp file, which is renamed
+        once the start and end have been checked. With refresh the cache is
+        only written to. '''
+    cached = None if refresh else cache_lookup(oql)
+    if cached:
+        print('overpass cache hit')
+        return copy_from_cache(cached, filename)
+
+    cached = cache_filename(oql)
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    download_to_file(oql, cached)
+    evict_cache()
+    copy_from_cache(cached, filename)
+
+def download_to_file(oql, filename):
+    r = run_query(oql, error_on_rate_limit=False, stream=True)
+    if r.status_code == 429:
+        raise RateLimited
+
+    tmp = filename + '.part'
+    head = tail = b''
+    if current_app.config.get('OVERPASS_COMPRESS', True):
+        out = gzip.open(tmp, 'wb', compresslevel=utils.gzip_level)
+    else:
+        out = open(tmp, 'wb')
+    with out:
+        for data in r.iter_content(chunk_size=download_chunk_size):
+            out.write(data)
+            if len(head) < 2048:
+                head += data[:2048 - len(head)]
+            tail = (tail + data)[-1024:]
+
+    error = download_error(head, tail)
+    if not error:
+        os.replace(tmp, filename)
+        return r
+
+    os.remove(tmp)
+    reply = head.decode('utf-8', 'replace')
+    if len(head) == 2048:
+        reply += '\n...\n' + tail.decode('utf-8', 'replace')
+    raise OverpassError(r, reply, error)
+
+def run_query_persistent(oql, filename, attempts=3, via_web=True,
+                         refresh=False):
+    ''' Save the result of a query to filename, retry on errors.
+        Returns False if the query can't be run. '''
+    cached = None if refresh else cache_lookup(oql)
+    if cached:
+        copy_from_cache(cached, filename)
+        return True
+
     for attempt in range(attempts):
         wait_for_slot()
         print('calling overpass')
-        r = run_query(oql, error_on_rate_limit=False)
-        if r is None:
+        try:
+            run_query_to_file(oql, filename, refresh=refresh)
+        except RateLimited:
             seconds = 30
             print('retrying, waiting {} seconds'.format(seconds))
             sleep(seconds)
             continue
-        if len(r.content) < 2000 and b'<remark> runtime error:' in r.content:
-
-            msg = 'runtime error'
-            mail.error_mail(msg, oql, r, via_web=via_web)
+        except OverpassError as e:
+            msg = 'overpass ' + e.error
+            mail.error_mail(msg, oql, e.r, via_web=via_web, reply=e.reply)
             print(msg)
-            if b'<remark> runtime error: Query run out of memory' in r.content:
-                return
+            if e.error == 'out of memory':
+                return False
             continue  # retry
 
-        if len(r.content) < 2000 and b'<title>504 Gateway' in r.content:
-            msg = 'overpass timeout'
-            mail.error_mail(msg, oql, r, via_web=via_web)
-            print(msg)
-            continue  # retry
-
-        return r
+        return True
+    return False
 
 def items_as_xml(items):
     assert items
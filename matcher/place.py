@@ -3,16 +3,18 @@ from .model import Base, Item, ItemCandidate, PlaceItem, ItemTag, Changeset, IsA
 from sqlalchemy.types import BigInteger, Float, Integer, JSON, String, DateTime, Boolean
 from sqlalchemy import func, select, cast
 from sqlalchemy.schema import ForeignKeyConstraint, ForeignKey, Column, UniqueConstraint
-from sqlalchemy.orm import relationship, backref, column_property, object_session, deferred, load_only
+from sqlalchemy.orm import relationship, backref, column_property, object_session, deferred, load_only, contains_eager
 from sqlalchemy.orm.exc import MultipleResultsFound
 from sqlalchemy.sql.expression import true, false, or_
 from geoalchemy2 import Geography, Geometry
 from sqlalchemy.ext.hybrid import hybrid_property
-from .database import session, get_tables, now_utc
-from . import wikidata, matcher, wikipedia, overpass, utils, nominatim, default_change_comments
-from collections import Counter
+from .database import session, get_tables, now_utc, get_place_table_sizes
+from . import wikidata, matcher, wikipedia, overpass, utils, nominatim, default_change_comments, osm_loader
+from collections import Counter, defaultdict
 from .overpass import oql_from_tag
 from time import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 import json
 import subprocess
@@ -29,6 +31,29 @@ base_osm_url = 'https://www.openstreetmap.org'
 
 overpass_types = {'way': 'way', 'relation': 'rel', 'node': 'node'}
 
+# tables created by osm2pgsql that the matcher searches
+osm_tables = ('point', 'line', 'polygon')
+
+# smaller overpass downloads are loaded by osm_loader instead of osm2pgsql
+osm_loader_max_size = 50 * 1024 * 1024  # bytes
+
+import_slots = 2  # OSM imports that can run at the same time
+chunk_workers = 4  # parallel chunk downloads outside the task queue
+
+# only record a visit to a place once in this time, to save DB writes
+touch_interval = timedelta(hours=1)
+
+# Overpass data can be a few minutes behind, ask for changes from a bit
+# before the tables were loaded
+osm_change_overlap = timedelta(hours=1)
+
+# osm2pgsql prefix for a local extract that batch matching copies from
+extract_prefix = 'osm_extract'
+
+osm2pgsql_min_cache = 100  # MB
+osm2pgsql_max_cache = 4000  # MB
+osm2pgsql_max_processes = 4
+
 skip_tags = {'route:road',
              'highway=primary',
              'highway=road',
@@ -73,6 +98,58 @@ def envelope(bbox):
     ymin, ymax, xmin, xmax = bbox
     return func.ST_MakeEnvelope(xmin, ymin, xmax, ymax, 4326)
 
+def osm2pgsql_resources(filename):
+    ''' Pick the osm2pgsql node cache in MB and the number of processes
+        from the size of the input and the memory that is free. '''
+    config = current_app.config
+    file_mb = utils.data_size(filename) // 2 ** 20
+    max_cache = config.get('OSM2PGSQL_MAX_CACHE', osm2pgsql_max_cache)
+    cache = min(max(file_mb // 2, osm2pgsql_min_cache), max_cache)
+
+    available = utils.get_available_memory()
+    if available:
+        # leave room for the other import slots and postgres
+        slots = config.get('IMPORT_SLOTS', import_slots)
+        share = available // 2 ** 20 // (slots * 2)
+        cache = max(min(cache, share), osm2pgsql_min_cache)
+
+    max_processes = config.get('OSM2PGSQL_MAX_PROCESSES',
+                               osm2pgsql_max_processes)
+    processes = min(max(file_mb // 256, 1), os.cpu_count() or 1,
+                    max_processes)
+    return cache, processes
+
+def osm2pgsql_cmd(prefix, filename):
+    cache, processes = osm2pgsql_resources(filename)
+    return ['osm2pgsql', '--create', '--drop', '--slim',
+            '--hstore-all', '--hstore-add-index',
+            '--prefix', prefix,
+            '--cache', str(cache),
+            '--number-processes', str(processes),
+            '--multi-geometry',
+            '--host', current_app.config['DB_HOST'],
+            '--username', current_app.config['DB_USER'],
+            '--database', current_app.config['DB_NAME'],
+            filename]
+
+def import_lock_dir():
+    config = current_app.config
+    return (config.get('IMPORT_LOCK_DIR') or
+            os.path.join(config['CACHE_DIR'], 'import_locks'))
+
+def import_slot(on_wait=None):
+    ''' Limit how many OSM imports run at once across every process. '''
+    slots = current_app.config.get('IMPORT_SLOTS', import_slots)
+    return utils.lock_slot(import_lock_dir(), slots, on_wait=on_wait)
+
+def import_extract(filename, prefix=extract_prefix):
+    ''' Load a local extract, such as a country .osm.pbf, with osm2pgsql.
+        Places copy their OSM tables from it, no Overpass needed. '''
+    env = {'PGPASSWORD': current_app.config['DB_PASS']}
+    with import_slot():
+        p = subprocess.run(osm2pgsql_cmd(prefix, filename), env=env)
+    return p.returncode == 0
+
 class Place(Base):
     __tablename__ = 'place'
     place_id = Column(BigInteger, primary_key=True, autoincrement=False)
@@ -104,6 +181,9 @@ class Place(Base):
     item_types_retrieved = Column(Boolean, default=False)
     index_hide = Column(Boolean, default=False)
     overpass_is_in = deferred(Column(JSON))
+    last_accessed = Column(DateTime)
+    shared_osm_tables = Column(Boolean, default=False)
+    osm_loaded = Column(DateTime)  # when the OSM objects were downloaded
 
     area = column_property(func.ST_Area(geom))
     geojson = column_property(func.ST_AsGeoJSON(geom, 4), deferred=True)
@@ -330,26 +410,42 @@ class Place(Base):
         # Would be nice to include OSM chunk information with each
         # item. Not doing it at this point because it means lots
         # of queries. Easier once the items are loaded into the database.
+        return self.covered_items(items)
+
+    def covered_items(self, items):
+        ''' Drop items that are outside the geometry of this place. '''
         return {k: v for k, v in items.items() if self.covers(v)}
 
     def items_from_wikidata(self, query_map):
-        rows = wikidata.run_query(query_map['enwiki'])
-        items = wikidata.parse_enwiki_query(rows)
-
-        try:  # add items with the coordinates in the HQ field
-            rows = wikidata.run_query(query_map['hq_enwiki'])
-            items.update(wikidata.parse_enwiki_query(rows))
-        except wikidata.QueryError:
-            pass  # HQ query timeout isn't fatal
-
-        rows = wikidata.run_query(query_map['item_tag'])
-        wikidata.parse_item_tag_query(rows, items)
-
-        try:  # add items with the coordinates in the HQ field
-            rows = wikidata.run_query(query_map['hq_item_tag'])
-            wikidata.parse_item_tag_query(rows, items)
-        except wikidata.QueryError:
-            pass  # HQ query timeout isn't fatal
+        def run_query(name):
+            rows = wikidata.stream_query(query_map[name])
+            try:
+                if name.endswith('enwiki'):
+                    return wikidata.parse_enwiki_query(rows)
+                tag_items = {}
+                wikidata.parse_item_tag_query(rows, tag_items)
+                return tag_items
+            except wikidata.QueryError:
+                if name.startswith('hq_'):
+                    return {}  # HQ query timeout isn't fatal
+                raise
+
+        # the queries are independent, run them at the same time
+        names = ['enwiki', 'hq_enwiki', 'item_tag', 'hq_item_tag']
+        results = dict(zip(names, utils.run_in_threads(run_query, names,
+                                                       max_workers=len(names))))
+
+        items = results['enwiki']
+
+        # add items with the coordinates in the HQ field
+        items.update(results['hq_enwiki'])
+
+        for name in 'item_tag', 'hq_item_tag':
+            for qid, item in results[name].items():
+                if qid in items:
+                    items[qid]['tags'] |= item['tags']
+                else:
+                    items[qid] = item
 
         return items
 
@@ -386,27 +482,60 @@ class Place(Base):
         place_id = str(self.place_id)
         return f == place_id + '.xml' or f.startswith(place_id + '_')
 
+    def overpass_data_time(self):
+        ''' When the oldest of this place's Overpass files was downloaded,
+            a file from the cache keeps the time of the original download. '''
+        mtimes = [f.stat().st_mtime
+                  for f in os.scandir(current_app.config['OVERPASS_DIR'])
+                  if f.is_file() and self.is_overpass_filename(f.name)]
+        if mtimes:
+            return datetime.utcfromtimestamp(min(mtimes))
+
     def delete_overpass(self):
         for f in os.scandir(current_app.config['OVERPASS_DIR']):
             if self.is_overpass_filename(f.name):
                 os.remove(f.path)
 
-    def clean_up(self):
-        place_id = self.place_id
+    def drop_osm_tables(self):
+        if self.shared_osm_tables:
+            self.run_osm_loader(osm_loader.remove_shared, self.place_id)
+            self.shared_osm_tables = False
 
         engine = session.bind
         for t in get_tables():
-            if not t.startswith(self.prefix):
+            if not t.startswith(self.prefix + '_'):
                 continue
             engine.execute(f'drop table if exists {t}')
         engine.execute('commit')
 
+    def clean_up(self):
+        place_id = self.place_id
+
+        self.drop_osm_tables()
+        session.commit()
+
         overpass_dir = current_app.config['OVERPASS_DIR']
         for f in os.listdir(overpass_dir):
             if not any(f.startswith(str(place_id) + end) for end in ('_', '.')):
                 continue
             os.remove(os.path.join(overpass_dir, f))
 
+    def osm_tables_loaded(self):
+        if self.shared_osm_tables:
+            sql = 'select exists (select 1 from osm_place_object where place_id = :id)'
+            return session.execute(sql, {'id': self.place_id}).scalar()
+        tables = set(get_tables())
+        return all(f'{self.prefix}_{t}' in tables for t in osm_tables)
+
+    def touch(self):
+        ''' Record that the place was used, the OSM tables of places nobody
+            looks at are the first to go. '''
+        now = datetime.utcnow()
+        if self.last_accessed and now - self.last_accessed < touch_interval:
+            return
+        self.last_accessed = now
+        session.commit()
+
     @property
     def overpass_done(self):
         return os.path.exists(self.overpass_filename)
@@ -473,15 +602,66 @@ class Place(Base):
     def osm2pgsql_cmd(self, filename=None):
         if filename is None:
             filename = self.overpass_filename
-        return ['osm2pgsql', '--create', '--drop', '--slim',
-                '--hstore-all', '--hstore-add-index',
-                '--prefix', self.prefix,
-                '--cache', '1000',
-                '--multi-geometry',
-                '--host', current_app.config['DB_HOST'],
-                '--username', current_app.config['DB_USER'],
-                '--database', current_app.config['DB_NAME'],
-                filename]
+        return osm2pgsql_cmd(self.prefix, filename)
+
+    def use_osm_loader(self, filename=None):
+        ''' Small files load faster in process than with osm2pgsql. '''
+        if filename is None:
+            filename = self.overpass_filename
+        max_size = current_app.config.get('OSM_LOADER_MAX_SIZE',
+                                          osm_loader_max_size)
+        return utils.data_size(filename) <= max_size
+
+    def run_osm_loader(self, func, *args):
+        conn = session.bind.raw_connection()
+        cur = conn.cursor()
+        func(cur, *args)
+        conn.commit()
+        conn.close()
+
+    def load_osm_data(self, filename=None):
+        if filename is None:
+            filename = self.overpass_filename
+        self.run_osm_loader(osm_loader.load, self.prefix, filename)
+        self.store_osm_tables()
+
+    def start_chunk_load(self):
+        ''' Chunks are loaded as they arrive, then combined into the tables. '''
+        self.run_osm_loader(osm_loader.create_staging, self.prefix)
+
+    def load_chunk(self, filename, on_wait=None):
+        with self.import_slot(on_wait=on_wait):
+            self.run_osm_loader(osm_loader.copy_file, self.prefix, filename)
+
+    def chunk_load_lock(self, on_wait=None):
+        ''' Held from start_chunk_load to finish_chunk_load, two matchers for
+            the same place would otherwise share one staging table. '''
+        lock_dir = os.path.join(import_lock_dir(), f'place_{self.place_id}')
+        return utils.lock_slot(lock_dir, 1, on_wait=on_wait)
+
+    def finish_chunk_load(self):
+        self.run_osm_loader(osm_loader.build_tables, self.prefix)
+        self.store_osm_tables()
+
+    def store_osm_tables(self):
+        ''' With OSM_SHARED_TABLES the tables that were just loaded are merged
+            into the shared tables, otherwise the place keeps its own. '''
+        self.osm_loaded = self.overpass_data_time() or datetime.utcnow()
+        if not current_app.config.get('OSM_SHARED_TABLES'):
+            if self.shared_osm_tables:  # loaded into the shared tables before
+                self.run_osm_loader(osm_loader.remove_shared, self.place_id)
+                self.shared_osm_tables = False
+            return
+        self.run_osm_loader(osm_loader.move_to_shared, self.prefix,
+                            self.place_id)
+        self.shared_osm_tables = True
+
+    @property
+    def osm_source(self):
+        ''' Where the matcher finds this place's OSM objects. '''
+        if self.shared_osm_tables:
+            return matcher.SharedTables(self.place_id)
+        return self.prefix
 
     def load_into_pgsql(self, filename=None, capture_stderr=True):
         if filename is None:
@@ -493,21 +673,179 @@ class Place(Base):
         if os.stat(filename).st_size == 0:
             return 'no data from overpass to load with osm2pgsql'
 
-        cmd = self.osm2pgsql_cmd(filename)
-
-        if not capture_stderr:
-            p = subprocess.run(cmd,
-                               env={'PGPASSWORD': current_app.config['DB_PASS']})
+        with self.import_slot():
+            if self.use_osm_loader(filename):
+                self.load_osm_data(filename)
+                return
+            error = self.run_osm2pgsql(filename, capture_stderr)
+        if not error:
+            self.store_osm_tables()
+        return error
+
+    @contextmanager
+    def osm2pgsql_input(self, filename=None):
+        ''' osm2pgsql picks the compression from the file extension, so a
+            gzipped download is given to it via an .osm.gz symlink. '''
+        if filename is None:
+            filename = self.overpass_filename
+        if not utils.is_gzip(filename):
+            yield filename
             return
-        p = subprocess.run(cmd,
-                           stderr=subprocess.PIPE,
-                           env={'PGPASSWORD': current_app.config['DB_PASS']})
+        link = filename + '.osm.gz'
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.abspath(filename), link)
+        try:
+            yield link
+        finally:
+            os.remove(link)
+
+    def run_osm2pgsql(self, filename, capture_stderr):
+        env = {'PGPASSWORD': current_app.config['DB_PASS']}
+
+        with self.osm2pgsql_input(filename) as osm2pgsql_filename:
+            cmd = self.osm2pgsql_cmd(osm2pgsql_filename)
+            if not capture_stderr:
+                subprocess.run(cmd, env=env)
+                return
+            p = subprocess.run(cmd, stderr=subprocess.PIPE, env=env)
         if p.returncode != 0:
             if b'Out of memory' in p.stderr:
                 return 'out of memory'
             else:
                 return p.stderr.decode('utf-8')
 
+    def import_slot(self, on_wait=None):
+        return import_slot(on_wait=on_wait)
+
+    def find_loaded_parent(self):
+        ''' Find a ready place that covers this one and was loaded with every
+            tag this place needs, so its OSM tables can be reused. '''
+        if self.is_point:
+            return
+
+        geom = (select([cast(Place.geom, Geometry)])
+                .where(Place.place_id == self.place_id)
+                .as_scalar())
+        q = (Place.query.filter(Place.state == 'ready',
+                                Place.place_id != self.place_id,
+                                Place.osm_type != 'node',
+                                func.ST_Covers(cast(Place.geom, Geometry), geom))
+                        .order_by(Place.area))
+
+        tags = None
+        for parent in q:
+            if not parent.osm_tables_loaded():
+                continue  # tables dropped by clean_up
+            if tags is None:
+                tags = self.all_tags  # the tags get_oql asks Overpass for
+            parent_tags = parent.all_tags
+            if all(t in parent_tags or t.partition('=')[0] in parent_tags
+                   for t in tags):
+                return parent
+
+    def copy_osm_tables(self, parent):
+        ''' Create this place's OSM tables from the rows of the parent's tables
+            that intersect this place, in place of an Overpass download. '''
+        if parent.shared_osm_tables:
+            self.drop_osm_tables()
+            self.run_osm_loader(osm_loader.copy_shared, parent.place_id,
+                                self.place_id, self.mercator_geom_sql())
+            self.shared_osm_tables = True
+            self.osm_loaded = parent.osm_loaded
+            return
+
+        self.copy_osm_tables_from(parent.prefix)
+        self.osm_loaded = parent.osm_loaded
+
+    def mercator_geom_sql(self):
+        return ('ST_Transform((select geom::geometry from place '
+                f'where place_id = {self.place_id}), 3857)')
+
+    def extract_covers(self, prefix):
+        ''' Does the extract loaded with this prefix have any OSM objects
+            inside this place? '''
+        geom = self.mercator_geom_sql()
+        sql = ' or '.join(f'exists (select 1 from {prefix}_{t} '
+                          f'where ST_Intersects(way, {geom}))'
+                          for t in osm_tables)
+        return session.execute('select ' + sql).scalar()
+
+    def copy_osm_tables_from(self, prefix):
+        ''' Create this place's OSM tables from the rows in {prefix}_point,
+            _line and _polygon that intersect this place. '''
+        geom = self.mercator_geom_sql()
+        engine = session.bind
+        for t in osm_tables:
+            table = f'{self.prefix}_{t}'
+            engine.execute(f'drop table if exists {table}')
+            engine.execute(f'create table {table} as '
+                           f'select * from {prefix}_{t} '
+                           f'where ST_Intersects(way, {geom})')
+            engine.execute(f'create index {table}_index '
+                           f'on {table} using gist (way)')
+            engine.execute(f'create index {table}_tags_index '
+                           f'on {table} using gin (tags)')
+        engine.execute('commit')
+        self.store_osm_tables()
+
+    def apply_osm_change(self, filename):
+        ''' Apply an osmChange file or Overpass augmented diff to the OSM
+            tables. Items near a changed object are marked as not done, so
+            only they are matched again. Returns the IDs of those items. '''
+        if self.shared_osm_tables:
+            prefix, place_id = 'osm', self.place_id
+        else:
+            prefix, place_id = self.prefix, None
+
+        by_dist = defaultdict(list)
+        for item in self.items:
+            dist = (matcher.get_max_dist_from_criteria(item.tags) or
+                    matcher.default_max_dist)
+            by_dist[dist].append(item.item_id)
+
+        conn = session.bind.raw_connection()
+        cur = conn.cursor()
+        changes = osm_loader.parse_change(filename)
+        osm_loader.apply_change(cur, prefix, changes, place_id=place_id)
+        item_ids = set()
+        for dist, ids in by_dist.items():
+            cur.execute('select item_id from item where item_id = any(%s) and '
+                        'exists (select 1 from osm_changed c where ST_DWithin('
+                        'ST_Transform(location::geometry, 3857), c.way, %s))',
+                        [ids, dist * 1000])
+            item_ids.update(item_id for item_id, in cur)
+        conn.commit()
+        conn.close()
+
+        if item_ids:
+            (PlaceItem.query.filter(PlaceItem.place == self,
+                                    PlaceItem.item_id.in_(item_ids))
+                            .update({'done': False}, synchronize_session=False))
+        session.commit()
+        return item_ids
+
+    def refresh_osm_changes(self):
+        ''' Update the OSM tables with an augmented diff from Overpass of the
+            changes since they were loaded. Returns None if that isn't
+            possible and a full refresh is needed. '''
+        if not self.osm_loaded or not self.osm_tables_loaded():
+            return
+
+        started = datetime.utcnow()
+        since = self.osm_loaded - osm_change_overlap
+        oql = overpass.adiff_oql(self.get_oql(), since)
+        filename = os.path.join(current_app.config['OVERPASS_DIR'],
+                                f'{self.place_id}_changes.xml')
+        if not overpass.run_query_persistent(oql, filename, refresh=True):
+            return
+
+        item_ids = self.apply_osm_change(filename)
+        os.remove(filename)
+        self.osm_loaded = started
+        session.commit()
+        return item_ids
+
     def save_overpass(self, content):
         with open(self.overpass_filename, 'wb') as out:
             out.write(content)
@@ -719,22 +1057,47 @@ class Place(Base):
 
         session.commit()
 
-    def load_extracts(self, debug=False, progress=None):
-        for code, count in self.languages_wikidata():
-            self.load_extracts_wiki(debug=debug, progress=progress, code=code)
+    def load_extracts(self, debug=False, progress=None, only_changed=False):
+        codes = [code for code, count in self.languages_wikidata()]
+        self.load_extracts_for_languages(codes,
+                                         debug=debug,
+                                         progress=progress,
+                                         only_changed=only_changed)
 
     def load_extracts_wiki(self, debug=False, progress=None, code='en'):
-        wiki = code + 'wiki'
-        by_title = {item.sitelinks()[wiki]['title']: item
-                    for item in self.items
-                    if wiki in (item.sitelinks() or {})}
-
-        query_iter = wikipedia.get_extracts(by_title.keys(), code=code)
-        for title, extract in query_iter:
-            item = by_title[title]
+        self.load_extracts_for_languages([code], debug=debug, progress=progress)
+
+    def load_extracts_for_languages(self, codes, debug=False, progress=None,
+                                    only_changed=False):
+        by_title = {}
+        for code in codes:
+            wiki = code + 'wiki'
+            by_title[code] = {item.sitelinks()[wiki]['title']: item
+                              for item in self.items
+                              if wiki in (item.sitelinks() or {})}
+
+        titles = {code: list(items.keys()) for code, items in by_title.items()}
+        if only_changed:
+            # skip pages where the stored extract is from the current revision
+            current = wikipedia.page_revids(titles)
+            for code, items in by_title.items():
+                wiki = code + 'wiki'
+                titles[code] = [
+                    title for title, item in items.items()
+                    if wiki not in item.wiki_extracts or
+                    item.wiki_extracts[wiki].revid is None or
+                    item.wiki_extracts[wiki].revid != current[code].get(title)]
+            if debug:
+                print('{} changed pages'.format(sum(len(t) for t in titles.values())))
+
+        # fetched in parallel, the items are only updated from this thread
+        for code, title, extract, revid in wikipedia.extracts_iter(titles):
+            wiki = code + 'wiki'
+            item = by_title[code][title]
             if debug:
                 print(title)
             item.extracts[wiki] = extract
+            item.wiki_extracts[wiki].revid = revid
             if wiki == 'enwiki':
                 item.extract_names = wikipedia.html_names(extract)
             if progress:
@@ -746,7 +1109,7 @@ class Place(Base):
                       .group_by(Item.item_id)
                       .subquery())
         q = (self.items.filter(Item.item_id == sub.c.item_id)
-                       .options(load_only(Item.qid)))
+                       .options(load_only(Item.qid, Item.entity)))
 
         if debug:
             print('running wbgetentities query')
@@ -756,10 +1119,13 @@ class Place(Base):
         if debug:
             print('{} items'.format(len(items)))
 
-        for qid, entity in wikidata.entity_iter(items.keys(), debug=debug):
+        known = {qid: item.entity for qid, item in items.items() if item.entity}
+        for qid, entity in wikidata.cached_entity_iter(items.keys(),
+                                                       known=known,
+                                                       debug=debug):
             if debug:
                 print(qid)
-            items[qid].entity = entity
+            items[qid].entity = wikidata.trim_entity(entity)
 
     def languages_osm(self):
         lang_count = Counter()
@@ -834,6 +1200,36 @@ class Place(Base):
             place_item.done = False
         session.commit()
 
+    def reset_changed_items_to_not_done(self):
+        ''' Mark items as not done if their matcher inputs have changed since
+            they were matched, the others keep their candidates. '''
+        place_items = (PlaceItem.query
+                                .join(Item)
+                                .options(contains_eager(PlaceItem.item)
+                                         .selectinload(Item.db_tags))
+                                .filter(Item.entity.isnot(None),
+                                        PlaceItem.place == self,
+                                        PlaceItem.done == true())
+                                .order_by(PlaceItem.item_id))
+
+        count = 0
+        for place_item in place_items:
+            if place_item.fingerprint != place_item.item.match_fingerprint():
+                place_item.done = False
+                count += 1
+        session.commit()
+        return count
+
+    def refresh_changed_items(self):
+        ''' For a refresh, update entities that were edited on Wikidata, then
+            reset the items that changed. '''
+        done = PlaceItem.query.filter(PlaceItem.place == self,
+                                      PlaceItem.done == true())
+        if not done.first():
+            return 0  # first run, every item gets matched
+        self.wbgetentities()
+        return self.reset_changed_items_to_not_done()
+
     def matcher_query(self):
         return (PlaceItem.query
                          .join(Item)
@@ -865,7 +1261,7 @@ class Place(Base):
                 candidates = []
             else:
                 t0 = time()
-                candidates = matcher.find_item_matches(cur, item, self.prefix, debug=debug)
+                candidates = matcher.find_item_matches(cur, item, self.osm_source, debug=debug)
                 seconds = time() - t0
                 if debug:
                     print('find_item_matches took {:.1f}'.format(seconds))
@@ -882,9 +1278,6 @@ class Place(Base):
                     c.bad_matches.delete()
                     session.delete(c)
 
-            if not candidates:
-                continue
-
             for i in candidates:
                 c = ItemCandidate.query.get((item.item_id, i['osm_id'], i['osm_type']))
                 if c:
@@ -894,6 +1287,7 @@ class Place(Base):
                     session.add(c)
 
             place_item.done = True
+            place_item.fingerprint = item.match_fingerprint()
 
             if num % 100 == 0:
                 session.commit()
@@ -906,13 +1300,14 @@ class Place(Base):
         conn.close()
 
     def load_isa(self):
-        items = [item.qid for item in self.items_with_instanceof()]
+        items = {item.qid: item.instanceof()
+                 for item in self.items_with_instanceof()}
         if not items:
             return
 
-        isa_map = {}
-        for cur in utils.chunk(items, 500):
-            isa_map.update(wikidata.get_isa(cur))
+        types = {isa_qid for isa_list in items.values() for isa_qid in isa_list}
+        graph = IsA.type_graph(types)
+        isa_map = wikidata.isa_from_graph(graph, items)
 
         download_isa = set()
         isa_obj_map = {}
@@ -935,15 +1330,20 @@ class Place(Base):
             item = Item.query.get(qid[1:])
             item.isa = isa_objects
 
-        for qid, entity in wikidata.entity_iter(download_isa):
+        for qid, entity in wikidata.cached_entity_iter(download_isa):
             isa_obj_map[qid].entity = entity
 
         session.commit()
 
-    def do_match(self, debug=True):
+    def do_match(self, debug=True, extract=None):
+        ''' Run every step of the matcher, with extract the OSM tables are
+            copied from an extract loaded by import_extract. '''
         if self.state == 'ready':  # already done
             return
 
+        # a refresh downloads fresh data instead of using the Overpass cache
+        refresh = self.state == 'refresh'
+
         if not self.state or self.state == 'refresh':
             print('load items')
             self.load_items()  # includes categories
@@ -958,10 +1358,25 @@ class Place(Base):
             self.state = 'wbgetentities'
             session.commit()
 
+        if self.state == 'wbgetentities' and extract:
+            print('copying OSM tables from', extract['prefix'])
+            self.copy_osm_tables_from(extract['prefix'])
+            self.osm_loaded = extract['loaded']
+            self.state = 'osm2pgsql'
+            session.commit()
+
+        # a refresh needs new data, not a copy of what a parent has loaded
+        if self.state == 'wbgetentities' and not refresh:
+            parent = self.find_loaded_parent()
+            if parent:
+                print('using OSM tables from', parent.display_name)
+                self.copy_osm_tables(parent)
+                self.state = 'osm2pgsql'
+                session.commit()
+
         if self.state in ('wbgetentities', 'overpass_error', 'overpass_timeout'):
             print('loading_overpass')
-            self.get_overpass()
-            self.state = 'postgis'
+            self.state = self.get_overpass(refresh=refresh)
             session.commit()
 
         if self.state == 'postgis':
@@ -983,14 +1398,18 @@ class Place(Base):
             self.state = 'ready'
             session.commit()
 
-    def get_overpass(self):
-        oql = self.get_oql()
+    def get_overpass(self, refresh=False):
+        ''' Returns the next state, large places are chunked and loaded into
+            the database as they download. '''
         if self.area_in_sq_km < 800:
-            r = overpass.run_query_persistent(oql)
-            assert r
-            self.save_overpass(r.content)
+            oql = self.get_oql()
+            if not overpass.run_query_persistent(oql, self.overpass_filename,
+                                                 refresh=refresh):
+                raise RuntimeError('overpass query failed')
+            return 'postgis'
         else:
-            self.chunk()
+            self.chunk(refresh=refresh)
+            return 'osm2pgsql'
 
     def get_items(self):
         items = [item for item in self.items_with_candidates()
@@ -1082,31 +1501,47 @@ class Place(Base):
             return '{}.xml'.format(self.place_id)
         return '{}_{:03d}_{:03d}.xml'.format(self.place_id, num, len(chunks))
 
-    def chunk(self):
+    def chunk(self, refresh=False):
+        ''' Download chunks in parallel, each one is loaded into the database
+            while the rest are downloading. '''
         chunk_size = utils.calc_chunk_size(self.area_in_sq_km)
         chunks = self.chunk_n(chunk_size)
 
         print('chunk size:', chunk_size)
 
-        files = []
+        todo = []
         for num, chunk in enumerate(chunks):
-            filename = self.chunk_filename(num, len(chunks))
-            # print(num, q.count(), len(tags), filename, list(tags))
+            filename = self.chunk_filename(num, chunks)
             full = os.path.join('overpass', filename)
-            files.append(full)
             if os.path.exists(full):
+                todo.append((full, None))
                 continue
             oql = self.oql_for_chunk(chunk, include_self=(num == 0))
-
-            r = overpass.run_query_persistent(oql)
-            if not r:
-                print(oql)
-            assert r
-            open(full, 'wb').write(r.content)
-
-        cmd = ['osmium', 'merge'] + files + ['-o', self.overpass_filename]
-        print(' '.join(cmd))
-        subprocess.run(cmd)
+            if oql:
+                todo.append((full, oql))
+
+        def download(chunk):
+            full, oql = chunk
+            if oql and not overpass.run_query_persistent(oql, full,
+                                                         refresh=refresh):
+                raise RuntimeError('overpass query failed: ' + full)
+            return full
+
+        workers = current_app.config.get('OVERPASS_CHUNK_WORKERS',
+                                         chunk_workers)
+        with self.chunk_load_lock():
+            session.refresh(self)
+            if self.state in ('osm2pgsql', 'load_isa', 'ready'):
+                print('OSM data loaded by another matcher')
+                return
+            self.start_chunk_load()
+            for full in utils.imap_in_threads(download, todo,
+                                              max_workers=workers):
+                print('loading', full)
+                self.load_chunk(full)
+
+            with self.import_slot():
+                self.finish_chunk_load()
 
     def oql_for_chunk(self, chunk, include_self=False):
         q = self.items.filter(cast(Item.location, Geometry).contained(envelope(chunk)))
@@ -1303,6 +1738,35 @@ class PlaceMatcher(Base):
         self.end = now_utc()
         session.commit()
 
+def evict_place_tables(max_size=None, dry_run=False):
+    ''' Drop the OSM tables and downloads of the least recently used places
+        until the tables fit in max_size bytes. Matcher results are kept, so
+        candidate pages still work. Returns a list of (place, size). '''
+    if max_size is None:
+        max_size = current_app.config.get('PLACE_TABLES_MAX_SIZE')
+    if not max_size:
+        return []
+
+    sizes = {place_id: size for place_id, size in get_place_table_sizes()}
+    total = sum(sizes.values())
+    if total <= max_size:
+        return []
+
+    # places still being matched need their tables
+    q = (Place.query.filter(Place.place_id.in_(sizes.keys()),
+                            Place.state.in_(['ready', 'complete']))
+                    .order_by(func.coalesce(Place.last_accessed, Place.added)))
+    evicted = []
+    for place in q:
+        if total <= max_size:
+            break
+        size = sizes[place.place_id]
+        if not dry_run:
+            place.clean_up()
+        evicted.append((place, size))
+        total -= size
+    return evicted
+
 def get_top_existing(limit=39):
     cols = [Place.place_id, Place.display_name, Place.area, Place.state,
             Place.candidate_count, Place.item_count]
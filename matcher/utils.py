@@ -1,9 +1,18 @@
 from flask import current_app, request, has_app_context, g
 from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import sleep
 from . import mail
 import os.path
+import fcntl
+import gzip
+import shutil
 import json
 import math
+import re
+import codecs
 import user_agents
 import humanize
 
@@ -11,10 +20,141 @@ metres_per_mile = 1609.344
 feet_per_metre = 3.28084
 feet_per_mile = 5280
 
+json_chunk_size = 64 * 1024
+
+gzip_magic = b'\x1f\x8b'
+gzip_level = 6
+# gzip files smaller than this are taken to hold under 4GB of data
+gzip_wrap_min_size = 64 * 1024 * 1024
+
 def chunk(it, size):
     it = iter(it)
     return iter(lambda: tuple(islice(it, size)), ())
 
+def config_value(key, default=None):
+    ''' Read a setting from the app config, fall back to default outside
+        of an app context or if the setting is missing. '''
+    if not has_app_context():
+        return default
+    return current_app.config.get(key, default)
+
+def run_in_threads(func, arg_list, max_workers=4):
+    ''' Call func for every item in arg_list using a pool of threads.
+        Results are returned in the same order as arg_list. Each worker
+        runs inside the current app context. '''
+    app = current_app._get_current_object() if has_app_context() else None
+
+    def call(arg):
+        if app is None:
+            return func(arg)
+        with app.app_context():
+            return func(arg)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(call, arg_list))
+
+def imap_in_threads(func, iterable, max_workers=4):
+    ''' Like map, but with up to max_workers calls running at the same time.
+        Results are yielded in order as soon as they are ready, the input
+        is consumed lazily. '''
+    app = current_app._get_current_object() if has_app_context() else None
+
+    def call(arg):
+        if app is None:
+            return func(arg)
+        with app.app_context():
+            return func(arg)
+
+    it = iter(iterable)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(call, arg)
+                        for arg in islice(it, max_workers))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for arg in islice(it, 1):
+                    pending.append(executor.submit(call, arg))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+def iter_json_array(chunks, key):
+    ''' Parse the array stored under key in a JSON document, yielding one
+        element at a time. chunks is an iterable of bytes, so the whole
+        document never needs to be in memory. The elements are expected to
+        be objects, arrays or strings. '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    marker = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    chunks = iter(chunks)
+
+    buf = ''
+    for data in chunks:
+        buf += text.decode(data)
+        m = marker.search(buf)
+        if m:
+            buf = buf[m.end():]
+            break
+        buf = buf[-(len(key) + 100):]  # marker might span two chunks
+    else:
+        raise ValueError('key not found in JSON: ' + key)
+
+    pos = 0
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            if pos == len(buf):
+                raise ValueError('need more data')
+            value, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            data = next(chunks, None)
+            if data is None:
+                raise ValueError('truncated JSON')
+            buf = buf[pos:] + text.decode(data)
+            pos = 0
+            continue
+        yield value
+
+def file_chunks(filename, chunk_size=json_chunk_size):
+    with open(filename, 'rb') as f:
+        yield from iter(lambda: f.read(chunk_size), b'')
+
+def is_gzip(filename):
+    with open(filename, 'rb') as f:
+        return f.read(2) == gzip_magic
+
+def open_data(filename):
+    ''' Open a data file for reading as bytes, decompress if it is gzipped. '''
+    return gzip.open(filename) if is_gzip(filename) else open(filename, 'rb')
+
+def data_size(filename):
+    ''' Size of the file contents once decompressed. Read from the gzip
+        trailer, which only holds the size modulo 4GB. '''
+    size = os.path.getsize(filename)
+    if not is_gzip(filename):
+        return size
+    with open(filename, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        isize = int.from_bytes(f.read(4), 'little')
+    # small or incompressible data can be smaller than the gzip file
+    if size > gzip_wrap_min_size:
+        while isize < size:
+            isize += 2 ** 32
+    return isize
+
+def gzip_file(filename):
+    ''' Compress a file in place, the file is replaced in one step. '''
+    tmp = filename + '.gz.part'
+    with open(filename, 'rb') as src, gzip.open(tmp, 'wb',
+                                                compresslevel=gzip_level) as out:
+        shutil.copyfileobj(src, out)
+    shutil.copystat(filename, tmp)
+    os.replace(tmp, filename)
+
 def flatten(l):
     return [item for sublist in l for item in sublist]
 
@@ -113,6 +253,39 @@ There is currently {} available.
 
     mail.send_mail(subject, body, config=config)
 
+def get_available_memory():
+    ''' Memory available to new processes in bytes, None if unknown. '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return
+
+@contextmanager
+def lock_slot(lock_dir, slots, on_wait=None, interval=5):
+    ''' Hold one of a pool of lock files, shared by every process on the
+        host. Waits for a free slot, calling on_wait while blocked. '''
+    os.makedirs(lock_dir, exist_ok=True)
+    while True:
+        for num in range(slots):
+            f = open(os.path.join(lock_dir, f'slot_{num}.lock'), 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            try:
+                yield num
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            return
+        if on_wait:
+            on_wait()
+        sleep(interval)
+
 def display_distance(units, dist):
     if units in ('miles_and_feet', 'miles_and_yards'):
         total_feet = dist * feet_per_metre
@@ -492,6 +492,7 @@ def candidates(osm_type, osm_id):
     if place.state not in ('ready', 'complete'):
         return redirect_to_matcher(place)
 
+    place.touch()
     multiple_match_count = place.items_with_multiple_candidates().count()
 
     if multiple_only:
@@ -653,23 +654,35 @@ def refresh_place(osm_type, osm_id):
 
     refresh_type = request.form['type']
 
-    place.reset_all_items_to_not_done()
+    if refresh_type == 'changes':
+        # only items near objects that changed in OSM are matched again
+        item_ids = place.refresh_osm_changes()
+        if item_ids is not None:
+            place.refresh_changed_items()
+            place.state = 'osm2pgsql'
+            database.session.commit()
+            flash(f'{len(item_ids):,d} items near OSM changes will be rematched')
+            return redirect_to_matcher(place)
+        refresh_type = 'full'
 
     if refresh_type == 'matcher':
-        place.state = 'osm2pgsql'
+        # the OSM tables might have been evicted to save space, otherwise
+        # only items with changed matcher inputs are matched again
+        if place.osm_tables_loaded():
+            place.refresh_changed_items()
+            place.state = 'osm2pgsql'
+        else:
+            place.reset_all_items_to_not_done()
+            place.state = 'wbgetentities'
         database.session.commit()
         return redirect_to_matcher(place)
 
     assert refresh_type == 'full'
+    place.reset_all_items_to_not_done()
     place.delete_overpass()
     place.state = 'refresh'
 
-    engine = database.session.bind
-    for t in database.get_tables():
-        if not t.startswith(place.prefix):
-            continue
-        engine.execute('drop table if exists {}'.format(t))
-    engine.execute('commit')
+    place.drop_osm_tables()
     database.session.commit()
 
     expect = [place.prefix + '_' + t for t in ('line', 'point', 'polygon')]
@@ -985,7 +998,7 @@ def api_get(wikidata_id, entity, radius):
     found = []
     if criteria:
         try:
-            overpass_reply = overpass.item_query(oql, qid, radius)
+            overpass_reply = overpass.item_query(oql)
         except overpass.RateLimited:
             return api_overpass_error(data, 'overpass rate limited')
         except overpass.Timeout:
@@ -1100,7 +1113,7 @@ def browse_page(item_id):
                 continue
             download_isa.add(isa_qid)
 
-    for isa_qid, entity in wikidata.entity_iter(download_isa):
+    for isa_qid, entity in wikidata.cached_entity_iter(download_isa):
         if isa_map[isa_qid]:
             isa_map[isa_qid].entity = entity
             continue
@@ -1279,7 +1292,7 @@ def build_item_page(wikidata_id, item):
         overpass_reply = []
     else:
         try:
-            overpass_reply = overpass.item_query(oql, qid, radius)
+            overpass_reply = overpass.item_query(oql)
         except overpass.RateLimited:
             return render_template('error_page.html',
                                    message='Overpass rate limit exceeded')
@@ -1330,6 +1343,8 @@ def space():
     files = [{'file': f, 'size': f.stat().st_size} for f in os.scandir(overpass_dir) if '_' not in f.name and f.name.endswith('.xml')]
     files.sort(key=lambda f: f['size'], reverse=True)
     files = files[:200]
+    for f in files:
+        f['data_size'] = utils.data_size(f['file'].path)
 
     place_lookup = {int(f['file'].name[:-4]): f for f in files}
     # q = Place.query.outerjoin(Changeset).filter(Place.place_id.in_(place_lookup.keys())).add_columns(func.count(Changeset.id))
@@ -1464,11 +1479,7 @@ def single_item_match(osm_type, osm_id, item_id):
     # qid = f'Q{item_id}'
     item = Item.query.get(item_id)
 
-    tables = database.get_tables()
-    ready = all(f'osm_{place.place_id}_{i}' in tables
-                for i in ('line', 'point', 'polygon'))
-
-    if not ready:
+    if not place.osm_tables_loaded():
         return render_template('place_not_ready.html', item=item, place=place)
 
     endings = matcher.get_ending_from_criteria(item.tags)
@@ -1477,7 +1488,7 @@ def single_item_match(osm_type, osm_id, item_id):
     conn = database.session.bind.raw_connection()
     cur = conn.cursor()
 
-    candidates = matcher.find_item_matches(cur, item, place.prefix, debug=False)
+    candidates = matcher.find_item_matches(cur, item, place.osm_source, debug=False)
 
     for c in candidates:
         del c['geom']
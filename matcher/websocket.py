@@ -1,6 +1,6 @@
 from flask import Blueprint, current_app, g
 from time import time, sleep
-from .place import Place, bbox_chunk
+from .place import Place, bbox_chunk, evict_place_tables
 from . import wikipedia, database, wikidata, netstring, utils, edit, mail
 from flask_login import current_user
 from .model import ItemCandidate, ChangesetEdit
@@ -77,21 +77,42 @@ class MatcherSocket(object):
         # FIXME - send error mail
 
     def wikidata_chunked(self, chunks):
+        place = self.place
+
+        def query_chunk(bbox):
+            query_map = wikidata.bbox_query_map(*bbox)
+            try:
+                return place.items_from_wikidata(query_map)
+            except wikidata.QueryTimeout:
+                return None
+
         items = {}
         num = 0
         while chunks:
-            bbox = chunks.pop()
-            num += 1
-            msg = f'requesting wikidata chunk {num}'
-            print(msg)
-            self.status(msg)
-            try:
-                items.update(self.place.bbox_wikidata_items(bbox))
-            except wikidata.QueryTimeout:
-                msg = f'wikidata timeout, splitting chunk {num} info four'
+            # chunks are taken from the end of the list, request them all at
+            # once and merge the results in the same order
+            batch = chunks[::-1]
+            chunks = []
+            batch_nums = []
+            for bbox in batch:
+                num += 1
+                batch_nums.append(num)
+                msg = f'requesting wikidata chunk {num}'
                 print(msg)
                 self.status(msg)
-                chunks += bbox_chunk(bbox, 2)
+
+            max_workers = wikidata.max_concurrent_queries()
+            results = utils.run_in_threads(query_chunk, batch,
+                                           max_workers=max_workers)
+
+            for chunk_num, bbox, chunk_items in zip(batch_nums, batch, results):
+                if chunk_items is None:
+                    msg = f'wikidata timeout, splitting chunk {chunk_num} info four'
+                    print(msg)
+                    self.status(msg)
+                    chunks += bbox_chunk(bbox, 2)
+                    continue
+                items.update(place.covered_items(chunk_items))
 
         return items
 
@@ -167,7 +188,7 @@ class MatcherSocket(object):
         sock.close()
         return reply['type'] == 'pong'
 
-    def overpass_request(self, chunks):
+    def overpass_request(self, chunks, on_chunk=None):
         sock = self.connect_to_task_queue()
 
         fields = ['place_id', 'osm_id', 'osm_type', 'area']
@@ -177,51 +198,45 @@ class MatcherSocket(object):
         }
 
         netstring.write(sock, json.dumps(msg))
+        reader = netstring.Reader(sock)
         complete = False
-        while True:
-            print('read')
-            from_network = netstring.read(sock)
-            print('read complete')
-            if from_network is None:
-                print('done')
-                break
-            msg = json.loads(from_network)
-            print('message type {}'.format(repr(msg['type'])))
-            if msg['type'] == 'connected':
-                print('task runnner connected')
-                self.send('connected')
-            elif msg['type'] == 'run_query':
-                chunk_num = msg['num']
-                self.send('get_chunk', chunk_num=chunk_num)
-            elif msg['type'] == 'chunk':
-                chunk_num = msg['num']
-                self.send('chunk_done', chunk_num=chunk_num)
-            elif msg['type'] == 'done':
-                complete = True
-                self.send('overpass_done')
-            elif msg['type'] == 'error':
-                self.error(msg['error'])
-            else:
-                self.status('from network: ' + from_network)
-            netstring.write(sock, 'ack')
+        try:
+            while True:
+                print('read')
+                from_network = reader.read()
+                print('read complete')
+                if from_network is None:
+                    print('done')
+                    break
+                msg = json.loads(from_network)
+                print('message type {}'.format(repr(msg['type'])))
+                if msg['type'] == 'connected':
+                    print('task runnner connected')
+                    self.send('connected')
+                elif msg['type'] == 'run_query':
+                    chunk_num = msg['num']
+                    self.send('get_chunk', chunk_num=chunk_num)
+                elif msg['type'] == 'chunk':
+                    chunk_num = msg['num']
+                    self.send('chunk_done', chunk_num=chunk_num)
+                    if on_chunk:
+                        on_chunk(msg['filename'])
+                elif msg['type'] == 'done':
+                    complete = True
+                    self.send('overpass_done')
+                elif msg['type'] == 'error':
+                    self.error(msg['error'])
+                elif msg['type'] == 'heartbeat':
+                    # fails if the browser has gone, the task queue then
+                    # sees the connection close and can cancel the download
+                    self.send('heartbeat')
+                else:
+                    self.status('from network: ' + from_network)
+                netstring.write(sock, 'ack')
+        finally:
+            sock.close()
         return complete
 
-    def merge_chunks(self, chunks):
-        files = [os.path.join('overpass', chunk['filename'])
-                 for chunk in chunks
-                 if chunk.get('oql')]
-
-        cmd = ['osmium', 'merge'] + files + ['-o', self.place.overpass_filename]
-        # status(' '.join(cmd))
-        p = subprocess.run(cmd,
-                           encoding='utf-8',
-                           universal_newlines=True,
-                           stderr=subprocess.PIPE,
-                           stdout=subprocess.PIPE)
-        msg = p.stdout if p.returncode == 0 else p.stderr
-        if msg:
-            self.status(msg)
-
     def send_pins(self, pins, item_count):
         self.send('pins', pins=pins)
         self.status('{:,d} Wikidata items found'.format(item_count))
@@ -233,9 +248,12 @@ class MatcherSocket(object):
 
         print('getting wikidata item details')
         self.status('getting wikidata item details')
-        for qid, entity in wikidata.entity_iter(db_items.keys()):
+        known = {qid: item.entity
+                 for qid, item in db_items.items() if item.entity}
+        for qid, entity in wikidata.cached_entity_iter(db_items.keys(),
+                                                       known=known):
             item = db_items[qid]
-            item.entity = entity
+            item.entity = wikidata.trim_entity(entity)
             msg = 'load entity: ' + item.label_and_qid()
             print(msg)
             self.item_line(msg)
@@ -246,15 +264,36 @@ class MatcherSocket(object):
         self.place.load_extracts(progress=extracts_progress)
         self.item_line('extracts loaded')
 
+    def waiting_for_import_slot(self):
+        self.status('waiting for import slot')
+
+    def waiting_for_other_load(self):
+        self.status('waiting for another matcher to load OSM data')
+
     def run_osm2pgsql(self):
-        self.status('running osm2pgsql')
-        cmd = self.place.osm2pgsql_cmd()
-        env = {'PGPASSWORD': current_app.config['DB_PASS']}
-        subprocess.run(cmd, env=env, check=True)
+        with self.place.import_slot(on_wait=self.waiting_for_import_slot):
+            if self.place.use_osm_loader():
+                self.status('loading OSM data')
+                self.place.load_osm_data()
+                self.status('OSM data loaded')
+                return
+
+            self.status('running osm2pgsql')
+            env = {'PGPASSWORD': current_app.config['DB_PASS']}
+            with self.place.osm2pgsql_input() as filename:
+                cmd = self.place.osm2pgsql_cmd(filename)
+                subprocess.run(cmd, env=env, check=True)
+            self.place.store_osm_tables()
         print('osm2pgsql done')
         self.status('osm2pgsql done')
         # could echo osm2pgsql output via websocket
 
+    def finish_chunk_load(self):
+        with self.place.import_slot(on_wait=self.waiting_for_import_slot):
+            self.status('combining chunks')
+            self.place.finish_chunk_load()
+        self.status('OSM data loaded')
+
     def run_matcher(self):
         def progress(candidates, item):
             num = len(candidates)
@@ -310,6 +349,49 @@ def replay_log(ws_sock, log_filename):
         ws_sock.send(line[:-1])
         prev_time = t
 
+def download_chunks(place, m, chunks):
+    ''' Get the chunks from the task queue, with more than one chunk each is
+        loaded into the database as it arrives. Returns False on error. '''
+    chunked = len(chunks) > 1
+    overpass_dir = current_app.config['OVERPASS_DIR']
+
+    def load_chunk(filename):
+        m.status('loading ' + filename)
+        place.load_chunk(os.path.join(overpass_dir, filename),
+                         on_wait=m.waiting_for_import_slot)
+
+    m.status('downloading data from overpass')
+    if chunked:
+        place.start_chunk_load()
+    try:
+        overpass_good = m.overpass_request(
+            chunks, on_chunk=load_chunk if chunked else None)
+    except ConnectionRefusedError:
+        m.error("unable to connect to task queue")
+        database.session.commit()
+        return False
+    if not overpass_good:
+        m.error('overpass error')
+        # FIXME: e-mail admin
+        return False
+
+    for chunk in chunks:
+        if not chunk['oql']:
+            continue  # empty chunk
+        filename = os.path.join(overpass_dir, chunk['filename'])
+        with utils.open_data(filename) as f:
+            head = f.read(2001)
+        if len(head) > 2000 or b'<remark> runtime error' not in head:
+            continue
+        root = etree.fromstring(head)
+        remark = root.find('.//remark')
+        m.error('overpass: ' + remark.text)
+        return False  # FIXME report error to admin
+
+    if chunked:
+        m.finish_chunk_load()
+    return True
+
 def run_matcher(place, m):
     running = m.check_task_queue_running()
     if not running:
@@ -327,6 +409,9 @@ def run_matcher(place, m):
 
     print('state:', place.state)
 
+    # a refresh downloads fresh data instead of using the Overpass cache
+    refresh = place.state == 'refresh'
+
     if not place.state or place.state == 'refresh':
         print('get items')
         try:
@@ -359,45 +444,46 @@ def run_matcher(place, m):
         place.state = 'wbgetentities'
         database.session.commit()
 
-    if place.osm_type == 'node':
-        oql = place.get_oql()
-        chunks = [{'filename': f'{place.place_id}.xml', 'num': 0, 'oql': oql}]
-    else:
-        chunks = place.get_chunks()
-        m.report_empty_chunks(chunks)
-
-    if place.overpass_done:
-        m.status('using existing overpass data')
-    else:
-        m.status('downloading data from overpass')
-        try:
-            overpass_good = m.overpass_request(chunks)
-        except ConnectionRefusedError:
-            m.error("unable to connect to task queue")
+    # a refresh needs new data, not a copy of what a parent has loaded
+    if place.state == 'wbgetentities' and not refresh:
+        parent = place.find_loaded_parent()
+        if parent:
+            m.status('using OSM data already loaded for ' + parent.name)
+            place.copy_osm_tables(parent)
+            place.state = 'osm2pgsql'
             database.session.commit()
-            return
-        if not overpass_good:
-            m.error('overpass error')
-            # FIXME: e-mail admin
-            return
 
-        overpass_dir = current_app.config['OVERPASS_DIR']
+    if place.state not in ('osm2pgsql', 'load_isa', 'refresh_isa'):
+        if place.osm_type == 'node':
+            oql = place.get_oql()
+            chunks = [{'filename': f'{place.place_id}.xml', 'num': 0, 'oql': oql}]
+        else:
+            chunks = place.get_chunks()
+            m.report_empty_chunks(chunks)
         for chunk in chunks:
-            if not chunk['oql']:
-                continue  # empty chunk
-            filename = os.path.join(overpass_dir, chunk['filename'])
-            if (os.path.getsize(filename) > 2000 or
-                    "<remark> runtime error" not in open(filename).read()):
-                continue
-            root = etree.parse(filename).getroot()
-            remark = root.find('.//remark')
-            m.error('overpass: ' + remark.text)
-            return  # FIXME report error to admin
-
-        if len(chunks) > 1:
-            m.merge_chunks(chunks)
-        place.state = 'postgis'
-        database.session.commit()
+            chunk['refresh'] = refresh
+
+        # with more than one chunk there is no merged overpass file
+        chunked = len(chunks) > 1
+
+        if place.overpass_done:
+            m.status('using existing overpass data')
+        elif chunked:
+            # staging tables are per place, only one matcher can load them
+            with place.chunk_load_lock(on_wait=m.waiting_for_other_load):
+                database.session.refresh(place)
+                if place.state in ('osm2pgsql', 'load_isa', 'ready'):
+                    m.status('OSM data loaded by another matcher')
+                elif download_chunks(place, m, chunks):
+                    place.state = 'osm2pgsql'
+                    database.session.commit()
+                else:
+                    return
+        else:
+            if not download_chunks(place, m, chunks):
+                return
+            place.state = 'postgis'
+            database.session.commit()
 
     if place.state == 'postgis':
         m.run_osm2pgsql()
@@ -429,6 +515,10 @@ def run_matcher(place, m):
     m.send('done')
     m.mark_log_good()
 
+    # the new tables might push the database over the space budget
+    for evicted, size in evict_place_tables():
+        print('evicted OSM tables:', evicted.display_name, size)
+
 def add_wikipedia_tag(root, m):
     if 'wiki_lang' not in m or root.find('.//tag[@k="wikipedia"]') is not None:
         return
@@ -1,14 +1,17 @@
 from flask import render_template_string, render_template
 from urllib.parse import unquote
 from collections import defaultdict
-from .utils import chunk, drop_start, cache_filename
+from .utils import (chunk, drop_start, cache_filename, config_value,
+                    imap_in_threads, iter_json_array, json_chunk_size)
 from .language import get_language_label
 from . import user_agent_headers, overpass, mail, language, match, matcher
 import requests
+import requests.adapters
 import requests.exceptions
 import os
 import json
 import simplejson.errors
+import threading
 import time
 
 page_size = 50
@@ -322,6 +325,23 @@ SELECT DISTINCT ?item ?itemLabel ?country ?countryLabel ?type ?typeLabel WHERE {
 }
 '''
 
+# superclasses of the given types that lead to a class with an OSM tag
+type_tree = '''
+SELECT DISTINCT ?item ?itemLabel ?country ?countryLabel ?type ?typeLabel WHERE {
+  {
+    VALUES ?top { ITEMS }
+    ?top wdt:P279* ?item .
+    ?item wdt:P279 ?type .
+    ?type wdt:P279* ?subtype .
+    ?subtype ((p:P1282/ps:P1282)|wdt:P641/(p:P1282/ps:P1282)|wdt:P140/(p:P1282/ps:P1282)|wdt:P366/(p:P1282/ps:P1282)) ?tag .
+  } UNION {
+    VALUES ?item { ITEMS }
+  }
+  OPTIONAL { ?item wdt:P17 ?country }
+  SERVICE wikibase:label { bd:serviceParam wikibase:language "en" }
+}
+'''
+
 subclasses = '''
 SELECT DISTINCT ?item ?itemLabel ?type ?typeLabel WHERE {
   VALUES ?item { ITEMS }
@@ -488,6 +508,51 @@ GROUP BY ?item ?itemLabel ?countryLabel
 
 wikidata_query_api_url = 'https://query.wikidata.org/bigdata/namespace/wdq/sparql'
 
+# The query service allows five concurrent queries per IP address.
+default_max_concurrent_queries = 5
+query_slots = None
+query_slots_lock = threading.Lock()
+
+# Number of wbgetentities pages to have in flight at the same time.
+default_max_concurrent_requests = 4
+http_session = None
+http_session_lock = threading.Lock()
+
+# Entities in the local store younger than this are used without checking
+# the current revision.
+default_entity_store_max_age = 60 * 60  # seconds
+
+# identifier properties that are compared with OSM tags
+property_map = [
+    ('P238', ['iata'], 'IATA airport code'),
+    ('P239', ['icao'], 'ICAO airport code'),
+    ('P240', ['faa', 'ref'], 'FAA airport code'),
+    # ('P281', ['addr:postcode', 'postal_code'], 'postal code'),
+    ('P296', ['ref', 'ref:train', 'railway:ref'], 'station code'),
+    ('P300', ['ISO3166-2'], 'ISO 3166-2 code'),
+    ('P649', ['ref:nrhp'], 'NRHP reference number'),
+    ('P722', ['uic_ref'], 'UIC station code'),
+    ('P836', ['ref:gss'], 'UK Government Statistical Service code'),
+    ('P856', ['website', 'contact:website', 'url'], 'website'),
+    ('P882', ['nist:fips_code'], 'FIPS 6-4 (US counties)'),
+    ('P883', ['state_code', 'ref', 'nist:fips_code'], 'FIPS 5-2 (code for US states)'),
+    # A UIC id can be a IBNR, but not every IBNR is an UIC id
+    ('P954', ['uic_ref'], 'IBNR ID'),
+    ('P1216', ['HE_ref'], 'National Heritage List for England number'),
+    ('P2253', ['ref:edubase'], 'EDUBase URN'),
+    ('P2815', ['esr:user', 'ref', 'ref:train'], 'ESR station code'),
+    ('P3562', ['seamark:light:reference'], 'Admiralty number'),
+    ('P4755', ['ref', 'ref:train', 'ref:crs'], 'UK railway station code'),
+    ('P4803', ['ref', 'ref:train'], 'Amtrak station code'),
+]
+
+# claims used by the matcher and the item pages, everything else is dropped
+# by trim_entity
+trim_claims = {'P17', 'P18', 'P31', 'P131', 'P137', 'P373', 'P625', 'P649',
+               'P1216', 'P1448', 'P1705'} | {pid for pid, _, _ in property_map}
+trim_keys = ['id', 'title', 'type', 'lastrevid', 'modified',
+             'labels', 'aliases', 'sitelinks']
+
 class QueryError(Exception):
     def __init__(self, query, r):
         self.query = query
@@ -540,6 +605,18 @@ def get_point_query(lat, lon, radius):
                                   lon=lon,
                                   radius=float(radius) / 1000.0)
 
+def max_concurrent_queries():
+    return config_value('WIKIDATA_MAX_CONCURRENT_QUERIES',
+                        default_max_concurrent_queries)
+
+def get_query_slots():
+    ''' Semaphore shared by every thread that sends a SPARQL query. '''
+    global query_slots
+    with query_slots_lock:
+        if query_slots is None:
+            query_slots = threading.BoundedSemaphore(max_concurrent_queries())
+    return query_slots
+
 def run_query(query, name=None, return_json=True, timeout=None, send_error_mail=True):
     attempts = 5
 
@@ -554,10 +631,11 @@ def run_query(query, name=None, return_json=True, timeout=None, send_error_mail=
 
     for attempt in range(attempts):
         try:  # retry if we get a ChunkedEncodingError
-            r = requests.post(wikidata_query_api_url,
-                              data={'query': query, 'format': 'json'},
-                              timeout=timeout,
-                              headers=user_agent_headers())
+            with get_query_slots():
+                r = requests.post(wikidata_query_api_url,
+                                  data={'query': query, 'format': 'json'},
+                                  timeout=timeout,
+                                  headers=user_agent_headers())
             if r.status_code != 200:
                 break
             if name:
@@ -571,17 +649,96 @@ def run_query(query, name=None, return_json=True, timeout=None, send_error_mail=
                 error_mail('wikidata query error', r)
                 raise QueryError(query, r)
 
+    query_error(query, r, send_error_mail)
+
+def is_timeout_reply(text):
     # query timeout generates two different exceptions
     # java.lang.RuntimeException: java.util.concurrent.ExecutionException: com.bigdata.bop.engine.QueryTimeoutException: Query deadline is expired.
     # java.util.concurrent.TimeoutException
-    if ('Query deadline is expired.' in r.text or
-            'java.util.concurrent.TimeoutException' in r.text):
-        error_mail('wikidata query timeout', r)
+    return ('Query deadline is expired.' in text or
+            'java.util.concurrent.TimeoutException' in text)
+
+def query_error(query, r, send_error_mail=True):
+    if is_timeout_reply(r.text):
+        if send_error_mail:
+            mail.error_mail('wikidata query timeout', query, r)
         raise QueryTimeout(query, r)
 
-    error_mail('wikidata query error', r)
+    if send_error_mail:
+        mail.error_mail('wikidata query error', query, r)
     raise QueryError(query, r)
 
+def stream_error(query, r, reply, is_timeout, send_error_mail=True):
+    ''' Raise QueryError or QueryTimeout for a query that failed part way
+        through the response, reply is the last data received. '''
+    is_timeout = is_timeout or is_timeout_reply(reply)
+    if send_error_mail and r is not None:
+        subject = 'wikidata query ' + ('timeout' if is_timeout else 'error')
+        mail.error_mail(subject, query, r, reply=reply)
+    raise (QueryTimeout if is_timeout else QueryError)(query, r)
+
+def stream_query(query, timeout=None, send_error_mail=True):
+    ''' Generator version of run_query, the bindings are parsed as they
+        arrive instead of loading the whole response. Errors before the
+        first row are retried like run_query, a query timeout is raised
+        straight away. '''
+    attempts = 5
+    slots = get_query_slots()
+    for attempt in range(attempts):
+        r = None
+        tail = [b'']
+        yielded = 0
+        slots.acquire()
+        holding = [True]
+
+        def release():
+            if holding[0]:
+                holding[0] = False
+                slots.release()
+
+        def chunks():
+            for data in r.iter_content(chunk_size=json_chunk_size):
+                tail[0] = data
+                yield data
+
+        try:
+            r = requests.post(wikidata_query_api_url,
+                              data={'query': query, 'format': 'json'},
+                              timeout=timeout,
+                              headers=user_agent_headers(),
+                              stream=True)
+            if r.status_code != 200:
+                release()
+                query_error(query, r, send_error_mail)
+
+            # hold back one row, so the slot is free before the last yield
+            prev = None
+            for row in iter_json_array(chunks(), 'bindings'):
+                if prev is not None:
+                    yielded += 1
+                    yield prev
+                prev = row
+            release()
+            r.close()
+            if prev is not None:
+                yield prev
+            return
+        except (requests.exceptions.RequestException, ValueError) as e:
+            reply = tail[0].decode('utf-8', errors='replace')
+            is_timeout = (isinstance(e, requests.exceptions.Timeout) or
+                          is_timeout_reply(reply))
+            connection_error = isinstance(e, (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError))
+            if (connection_error and not is_timeout and not yielded and
+                    attempt < attempts - 1):
+                continue  # nothing sent to the caller yet, try again
+            stream_error(query, r, reply, is_timeout, send_error_mail)
+        finally:
+            release()
+            if r is not None:
+                r.close()
+
 def flatten_criteria(items):
     start = {'Tag:' + i[4:] + '=' for i in items if i.startswith('Key:')}
     return {i for i in items if not any(i.startswith(s) for s in start)}
@@ -638,7 +795,25 @@ def parse_item_tag_query(rows, items):
                     items[qid][k] = row[k]['value']
         items[qid]['tags'].add(tag_or_key)
 
-def entity_iter(ids, debug=False):
+def get_session():
+    ''' Keep-alive HTTP session shared by the wbgetentities requests. '''
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            pool_size = max_concurrent_requests()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=pool_size)
+            s = requests.Session()
+            s.mount('https://', adapter)
+            s.headers.update(user_agent_headers())
+            http_session = s
+    return http_session
+
+def max_concurrent_requests():
+    return config_value('WIKIDATA_MAX_CONCURRENT_REQUESTS',
+                        default_max_concurrent_requests)
+
+def get_entity_page(ids, props=None):
     attempts = 5
 
     wikidata_url = 'https://www.wikidata.org/w/api.php'
@@ -646,43 +821,142 @@ def entity_iter(ids, debug=False):
         'format': 'json',
         'formatversion': 2,
         'action': 'wbgetentities',
+        'ids': '|'.join(ids),
     }
-    for num, cur in enumerate(chunk(ids, page_size)):
+    if props:
+        params['props'] = props
+    for attempt in range(attempts):
+        try:
+            r = get_session().get(wikidata_url, params=params)
+            break
+        except requests.exceptions.ChunkedEncodingError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(1)
+    r.raise_for_status()
+    return r.json()['entities']
+
+def entity_iter(ids, debug=False):
+    pages = chunk(ids, page_size)
+    entity_pages = imap_in_threads(get_entity_page, pages,
+                                   max_workers=max_concurrent_requests())
+    for num, entities in enumerate(entity_pages):
         if debug:
             print('entity_iter: {}/{}'.format(num * page_size, len(ids)))
-        params['ids'] = '|'.join(cur)
-        for attempt in range(attempts):
-            try:
-                r = requests.get(wikidata_url,
-                                 params=params,
-                                 headers=user_agent_headers())
-                break
-            except requests.exceptions.ChunkedEncodingError:
-                if attempt == attempts - 1:
-                    raise
-                time.sleep(1)
-        r.raise_for_status()
-        json_data = r.json()
-        for qid, entity in json_data['entities'].items():
+        for qid, entity in entities.items():
+            yield qid, entity
+
+def entity_store_dir():
+    default = os.path.join(config_value('CACHE_DIR', ''), 'entities')
+    return config_value('ENTITY_STORE_DIR', default)
+
+def entity_store_max_age():
+    return config_value('ENTITY_STORE_MAX_AGE', default_entity_store_max_age)
+
+def entity_store_filename(qid):
+    ''' Entities are spread over 1000 sub-directories to keep them small. '''
+    shard = '{:03d}'.format(int(qid[1:]) % 1000)
+    return os.path.join(entity_store_dir(), shard, qid + '.json')
+
+def read_stored_entity(qid):
+    filename = entity_store_filename(qid)
+    try:
+        with open(filename) as f:
+            return json.load(f), os.stat(filename).st_mtime
+    except (OSError, ValueError):
+        return None, None
+
+def store_entity(qid, entity):
+    ''' Write to a temp file and rename, so readers in other processes
+        never see a partial entity. '''
+    filename = entity_store_filename(qid)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(entity, f)
+    os.replace(tmp, filename)
+
+def touch_stored_entity(qid):
+    try:
+        os.utime(entity_store_filename(qid))
+    except OSError:
+        pass
+
+def get_lastrevids(ids):
+    ''' Cheap revision check, returns a dict mapping QID to lastrevid. '''
+    get_info = lambda page: get_entity_page(page, props='info')
+    pages = imap_in_threads(get_info, chunk(ids, page_size),
+                            max_workers=max_concurrent_requests())
+    return {qid: entity['lastrevid']
+            for entities in pages
+            for qid, entity in entities.items()
+            if 'lastrevid' in entity}
+
+def cached_entity_iter(ids, known=None, debug=False):
+    ''' Like entity_iter, but entities in the local store or in known that
+        are still at the current revision are not downloaded again. '''
+    known = known or {}
+    max_age = entity_store_max_age()
+    now = time.time()
+
+    candidates = {}
+    in_store = set()
+    download = []
+    for qid in ids:
+        entity = known.get(qid)
+        if entity and 'lastrevid' in entity:
+            candidates[qid] = entity
+            continue
+        entity, mtime = read_stored_entity(qid)
+        if not entity:
+            download.append(qid)
+        elif now - mtime < max_age:
             yield qid, entity
+        else:
+            candidates[qid] = entity
+            in_store.add(qid)
+
+    current = get_lastrevids(list(candidates.keys())) if candidates else {}
+    for qid, entity in candidates.items():
+        if current.get(qid) != entity['lastrevid']:
+            download.append(qid)
+            continue
+        if qid in in_store:
+            touch_stored_entity(qid)
+        yield qid, entity
+
+    if debug:
+        print('entity store: {} entities to download'.format(len(download)))
+
+    for qid, entity in entity_iter(download, debug=debug):
+        if 'missing' not in entity and 'lastrevid' in entity:
+            store_entity(qid, entity)
+        yield qid, entity
 
 def get_entity(qid):
-    wikidata_url = 'https://www.wikidata.org/w/api.php'
-    params = {
-        'format': 'json',
-        'formatversion': 2,
-        'action': 'wbgetentities',
-        'ids': qid,
-    }
-    json_data = requests.get(wikidata_url,
-                             params=params,
-                             headers=user_agent_headers()).json()
     try:
-        entity = list(json_data['entities'].values())[0]
+        for _, entity in cached_entity_iter([qid]):
+            if 'missing' not in entity:
+                return entity
     except KeyError:
         return None
-    if 'missing' not in entity:
+
+def trim_snak(snak):
+    return {k: v for k, v in snak.items() if k != 'hash'}
+
+def trim_entity(entity):
+    ''' Drop the parts of an entity that the matcher never reads:
+        descriptions, qualifiers, references and unused claims. '''
+    if not entity or 'missing' in entity:
         return entity
+    trimmed = {k: entity[k] for k in trim_keys if k in entity}
+    if 'claims' in entity:
+        trimmed['claims'] = {
+            pid: [{'mainsnak': trim_snak(c['mainsnak']), 'rank': c.get('rank')}
+                  for c in claims]
+            for pid, claims in entity['claims'].items()
+            if pid in trim_claims}
+    return trimmed
 
 def entity_label(entity):
     if 'en' in entity['labels']:
@@ -705,8 +979,7 @@ def get_entities(ids):
     attempts = 5
     for attempt in range(attempts):
         try:  # retry if we get a ChunkedEncodingError
-            r = requests.get(wikidata_url, params=params,
-                                           headers=user_agent_headers())
+            r = get_session().get(wikidata_url, params=params)
             try:
                 json_data = r.json()
             except simplejson.errors.JSONDecodeError:
@@ -947,30 +1220,39 @@ def row_qid_and_label(row, name):
 
 def get_isa(items, name=None):
     graph = item_types_graph(items, name=name)
+    item_types = {qid: graph[qid]['children'] for qid in items if qid in graph}
+    return isa_from_graph(graph, item_types)
 
+def isa_from_graph(graph, item_types):
+    ''' Work out the is-a list for each item. graph maps type QID to a node
+        with qid, label, children (superclasses) and an optional country.
+        item_types maps item QID to the QIDs of its instance-of types. '''
     ret = {}
-    for qid in items:
-        if qid not in graph:
+    for qid, types in item_types.items():
+        visited, queue = {qid}, [t for t in types if t in graph]
+        if not queue:
             continue
-        visited, queue = set(), [qid]
         result = []
         while queue:
             vertex = queue.pop(0)
             if vertex in visited:
                 continue
-            if vertex != qid:
-                result.append(graph[vertex])
+            node = dict(graph[vertex])
+            result.append(node)
             visited.add(vertex)
-            if ((vertex == qid or 'country' in graph[vertex]) and
-                    'children' in graph[vertex]):
-                queue.extend(graph[vertex]['children'] - visited)
+            if 'country' in node and node.get('children'):
+                queue.extend(c for c in node['children'] - visited
+                             if c in graph)
 
         drop = set()
-        for i in result[:]:
+        for i in result:
             if not (len(i.get('children', [])) == 1 and 'country' in i and
                     any(c.isupper() for c in i['label'])):
                 continue
-            child = graph[list(i['children'])[0]]['label']
+            child_qid = list(i['children'])[0]
+            if child_qid not in graph:
+                continue
+            child = graph[child_qid]['label']
             if i['label'].startswith(child):
                 drop.add(i['qid'])
             else:
@@ -987,6 +1269,34 @@ def get_isa(items, name=None):
         ret[qid] = [i for i in result if i['qid'] not in all_children]
     return ret
 
+def get_type_graph(types):
+    ''' Fetch the part of the subclass-of graph above the given types.
+        Every type in the result has its complete list of children. '''
+    graph = {}
+
+    def add_node(qid, label):
+        if qid not in graph:
+            graph[qid] = {'qid': qid, 'label': label, 'children': set()}
+        return graph[qid]
+
+    query = query_for_items(type_tree, types)
+    for row in run_query(query, send_error_mail=False):
+        item_qid = wd_to_qid(row['item'])
+        if not item_qid:
+            continue
+        node = add_node(item_qid, row['itemLabel']['value'])
+        if 'country' in row and 'country' not in node:
+            country = row_qid_and_label(row, 'country')
+            if country:
+                node['country'] = country
+
+        type_qid = wd_to_qid(row['type']) if 'type' in row else None
+        if type_qid:
+            add_node(type_qid, row['typeLabel']['value'])
+            node['children'].add(type_qid)
+
+    return graph
+
 def item_types_graph(items, name=None, rows=None):
     if rows is None:
         query = query_for_items(item_types_tree, items)
@@ -1,14 +1,57 @@
 import requests
+import requests.adapters
 import lxml.html
-from .utils import chunk, drop_start
+import threading
+from datetime import datetime, timedelta
+from itertools import zip_longest
+from sqlalchemy import text
+from .utils import chunk, drop_start, config_value, imap_in_threads
+from .database import session
 from . import user_agent_headers, mail
 
 page_size = 50
 extracts_page_size = 20
 query_url = 'https://{}.wikipedia.org/w/api.php'
 
+# limits for the number of API requests in flight, in total and per wiki
+default_max_concurrent_requests = 8
+default_max_requests_per_host = 3
 
-def run_query(titles, params, language_code='en'):
+# how long categories in the page_categories table are used without refetching
+default_page_categories_max_age = 7 * 24 * 60 * 60  # seconds
+
+http_session = None
+host_slots = {}
+lock = threading.Lock()
+
+def max_concurrent_requests():
+    return config_value('WIKIPEDIA_MAX_CONCURRENT_REQUESTS',
+                        default_max_concurrent_requests)
+
+def get_session():
+    ''' Keep-alive HTTP session shared by every Wikipedia API request. '''
+    global http_session
+    with lock:
+        if http_session is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=20,
+                pool_maxsize=max_concurrent_requests())
+            s = requests.Session()
+            s.mount('https://', adapter)
+            s.headers.update(user_agent_headers())
+            http_session = s
+    return http_session
+
+def get_host_slots(host):
+    with lock:
+        if host not in host_slots:
+            limit = config_value('WIKIPEDIA_MAX_REQUESTS_PER_HOST',
+                                 default_max_requests_per_host)
+            host_slots[host] = threading.BoundedSemaphore(limit)
+    return host_slots[host]
+
+
+def query(titles, params, language_code='en'):
     base = {
         'format': 'json',
         'formatversion': 2,
@@ -20,7 +63,8 @@ def run_query(titles, params, language_code='en'):
     p.update(params)
 
     url = query_url.format(language_code)
-    r = requests.get(url, params=p, headers=user_agent_headers())
+    with get_host_slots(language_code):
+        r = get_session().get(url, params=p)
     expect = 'application/json; charset=utf-8'
     success = True
     if r.status_code != 200:
@@ -32,24 +76,73 @@ def run_query(titles, params, language_code='en'):
     if not success:
         mail.error_mail('wikipedia error', p, r)
     assert success
-    json_reply = r.json()
-    return json_reply['query']['pages']
+    return r.json()['query']
+
+def run_query(titles, params, language_code='en'):
+    return query(titles, params, language_code)['pages']
 
 def get_cats(titles, language_code='en'):
-    params = {'prop': 'categories', 'cllimit': 'max', 'clshow': '!hidden'}
-    return run_query(titles, params, language_code)
+    ''' Pages with categories, requested_title is the title we asked for,
+        the API might have returned a normalized version. '''
+    params = {'prop': 'categories|info',
+              'cllimit': 'max',
+              'clshow': '!hidden'}
+    reply = query(titles, params, language_code)
+    requested = {n['to']: n['from'] for n in reply.get('normalized', [])}
+    for page in reply['pages']:
+        page['requested_title'] = requested.get(page['title'], page['title'])
+    return reply['pages']
 
 def get_coords(titles, language_code='en'):
     return run_query(titles, {'prop': 'coordinates'}, language_code)
 
+def cached_page_categories(titles):
+    ''' Look up enwiki articles in the page_categories table, entries older
+        than PAGE_CATEGORIES_MAX_AGE are ignored. '''
+    max_age = config_value('PAGE_CATEGORIES_MAX_AGE',
+                           default_page_categories_max_age)
+    since = datetime.utcnow() - timedelta(seconds=max_age)
+    sql = text('''
+select title, categories from page_categories
+where title = any(:titles) and fetched > :since''')
+    rows = session.execute(sql, {'titles': list(titles), 'since': since})
+    return {row.title: row.categories for row in rows}
+
+def save_page_categories(pages):
+    sql = text('''
+insert into page_categories (title, categories, revid, fetched)
+values (:title, :categories, :revid, timezone('utc', now()))
+on conflict (title) do update
+set categories = excluded.categories,
+    revid = excluded.revid,
+    fetched = excluded.fetched''')
+    session.execute(sql, pages)
+
 def page_category_iter(titles):
-    for cur in chunk(titles, page_size):
-        for page in get_cats(cur):
-            if 'categories' not in page:  # redirects
-                continue
-            cats = [drop_start(cat['title'], 'Category:')
-                    for cat in page['categories']]
-            yield (page['title'], cats)
+    titles = list(titles)
+    cached = cached_page_categories(titles)
+    for title in titles:
+        if title in cached and cached[title] is not None:
+            yield (title, cached[title])
+
+    missing = [title for title in titles if title not in cached]
+    pages = imap_in_threads(get_cats, chunk(missing, page_size),
+                            max_workers=max_concurrent_requests())
+    for cur in pages:
+        to_save = []
+        for page in cur:
+            cats = None
+            if 'categories' in page:  # redirects don't have categories
+                cats = [drop_start(cat['title'], 'Category:')
+                        for cat in page['categories']]
+            # store under the title the caller will look up
+            to_save.append({'title': page['requested_title'],
+                            'categories': cats,
+                            'revid': page.get('lastrevid')})
+            if cats is not None:
+                yield (page['requested_title'], cats)
+        if to_save:
+            save_page_categories(to_save)
 
 def add_enwiki_categories(items):
     enwiki_to_item = {v['enwiki']: v for v in items.values() if 'enwiki' in v}
@@ -66,7 +159,7 @@ def get_items_with_cats(items):
                 continue
             cats = [drop_start(cat['title'], 'Category:')
                     for cat in page['categories']]
-            items[page['title']]['cats'] = cats
+            items[page['requested_title']]['cats'] = cats
 
 def html_names(article):
     if not article or article.strip() == '':
@@ -80,18 +173,57 @@ def html_names(article):
 
 def extracts_query(titles, language_code='en'):
     params = {
-        'prop': 'extracts',
+        'prop': 'extracts|info',
         'exlimit': extracts_page_size,
         'exintro': '1',
     }
     return run_query(titles, params, language_code)
 
 def get_extracts(titles, code='en'):
-    for cur in chunk(titles, extracts_page_size):
-        for page in extracts_query(cur, language_code=code):
+    for code, title, extract, revid in extracts_iter({code: titles}):
+        yield (title, extract)
+
+def pages_by_code(titles_by_code, size):
+    ''' Pages of titles taken round-robin from each language, so requests to
+        different hosts run in parallel instead of queueing on one. '''
+    by_code = [[(code, cur) for cur in chunk(titles, size)]
+               for code, titles in titles_by_code.items()]
+    return [page
+            for pages in zip_longest(*by_code)
+            for page in pages if page is not None]
+
+def extracts_iter(titles_by_code):
+    ''' Fetch extracts for several languages at the same time.
+        Yields (code, title, extract, revid). '''
+    def fetch(page):
+        code, cur = page
+        return code, extracts_query(cur, language_code=code)
+
+    pages = pages_by_code(titles_by_code, extracts_page_size)
+    results = imap_in_threads(fetch, pages,
+                              max_workers=max_concurrent_requests())
+    for code, reply in results:
+        for page in reply:
             if 'extract' not in page:
                 continue
             extract = page['extract'].strip()
             if extract:
-                yield (page['title'], page['extract'])
+                yield (code, page['title'], page['extract'],
+                       page.get('lastrevid'))
+
+def page_revids(titles_by_code):
+    ''' Cheap check of the current revision of each page.
+        Returns a dict of dicts: code -> title -> revid. '''
+    def fetch(page):
+        code, cur = page
+        return code, run_query(cur, {'prop': 'info'}, code)
 
+    pages = pages_by_code(titles_by_code, page_size)
+    results = imap_in_threads(fetch, pages,
+                              max_workers=max_concurrent_requests())
+    ret = {code: {} for code in titles_by_code}
+    for code, reply in results:
+        for page in reply:
+            if 'lastrevid' in page:
+                ret[code][page['title']] = page['lastrevid']
+    return ret
@@ -1,10 +1,9 @@
 #!/usr/bin/python3
 from matcher.model import Place, Item, ItemCandidate
-from matcher import database, user_agent_headers, matcher, wikidata
+from matcher import database, matcher, wikidata
 from matcher.view import app
-from matcher.overpass import wait_for_slot, get_status  # noqa: F401
+from matcher.overpass import run_query_persistent
 from time import sleep
-import requests
 import sys
 
 def do_reindex(place, force=False):
@@ -41,19 +40,15 @@ def do_reindex(place, force=False):
     print(sorted(all_tags))
     sleep(10)
 
-    tables = database.get_tables()
-    expect = [place.prefix + '_' + t for t in ('line', 'point', 'polygon')]
-    if not all(t in tables for t in expect) or place.all_tags != all_tags:
+    if not place.osm_tables_loaded() or place.all_tags != all_tags:
         if not place.overpass_done:
             oql = place.get_oql()
-            overpass_url = 'https://overpass-api.de/api/interpreter'
 
-            wait_for_slot()
             print('running overpass query')
-            r = requests.post(overpass_url, data=oql, headers=user_agent_headers())
+            if not run_query_persistent(oql, place.overpass_filename,
+                                        via_web=False):
+                raise RuntimeError('overpass query failed')
             print('overpass done')
-
-            place.save_overpass(r.content)
         place.state = 'postgis'
         database.session.commit()
 
@@ -67,7 +62,7 @@ def do_reindex(place, force=False):
 
     q = place.items.filter(Item.entity.isnot(None)).order_by(Item.item_id)
     for item in q:
-        candidates = matcher.find_item_matches(cur, item, place.prefix, debug=False)
+        candidates = matcher.find_item_matches(cur, item, place.osm_source, debug=False)
         for i in (candidates or []):
             c = ItemCandidate.query.get((item.item_id, i['osm_id'], i['osm_type']))
             if not c:
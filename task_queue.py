@@ -1,29 +1,39 @@
 #!/usr/bin/python3
 from gevent.server import StreamServer
-from gevent.queue import PriorityQueue, Queue
-from gevent import monkey, spawn, sleep
+from gevent.queue import PriorityQueue, Queue, Empty
+from gevent.lock import Semaphore
+from gevent import monkey, spawn, spawn_later, sleep
 monkey.patch_all()
 
 from matcher import overpass, netstring, utils, mail
 from matcher.view import app
+from itertools import count
+from time import time
 import requests.exceptions
 import json
 import os.path
+import traceback
 
-# Priority queue
-# We should switch to a priority queue ordered by number of chunks
-# if somebody requests a place with 10 chunks they should go to the back
-# of the queue
-#
-# Abort request
-# If a user gives up and closes the page do we should remove their request from
-# the queue if nobody else has made the same request.
-#
-# We can tell the page was closed by checking a websocket heartbeat.
+# Places are queued shortest job first: the priority is the number of chunks
+# that still need to be downloaded. Requests for a place that is already
+# queued join the existing job, a job is cancelled once every client that
+# asked for it has gone away. Clients are sent a heartbeat while they wait,
+# so closed connections are noticed. Queued places are saved to disk and
+# resumed after a restart.
 
 app.config.from_object('config.default')
 
 task_queue = PriorityQueue()
+chunk_queue = PriorityQueue()
+job_counter = count()
+jobs = {}  # place_id -> job, for requests still in progress
+heartbeat_interval = 20  # seconds
+# a job resumed after a restart is dropped if no client asks for it again
+resume_timeout = 300  # seconds
+
+# number of greenlets downloading chunks, they share the Overpass slots
+default_chunk_workers = 4
+status_max_age = 30  # seconds before the status page is checked again
 
 listen_host, port = 'localhost', 6020
 
@@ -31,83 +41,299 @@ listen_host, port = 'localhost', 6020
 # should give status update as each chunk is loaded.
 # tell client the length of the rate limit pause
 
-def to_client(send_queue, msg_type, msg):
+class OverpassUnavailable(Exception):
+    pass
+
+class OverpassSlots:
+    ''' Hand out Overpass rate limit slots to the chunk workers.
+
+        The status page lists how many slots are free now and when each busy
+        slot will be released. Workers take the earliest slot, the status
+        page is checked again when the local view is empty or out of date. '''
+
+    def __init__(self):
+        self.lock = Semaphore()
+        self.free_at = []
+        self.checked = 0
+        self.not_before = 0
+        self.rate_limited_count = 0
+
+    def refresh(self):
+        print('get status')
+        try:
+            status = overpass.get_status()
+        except overpass.OverpassError as e:
+            r = e.args[0]
+            body = f'URL: {r.url}\n\nresponse:\n{r.text}'
+            mail.send_mail('Overpass API unavailable', body)
+            raise OverpassUnavailable
+        except requests.exceptions.Timeout:
+            body = 'Timeout talking to overpass API'
+            mail.send_mail('Overpass API timeout', body)
+            raise OverpassUnavailable
+
+        print('status:', status)
+        now = time()
+        if not status['rate_limit']:  # no rate limit
+            available = chunk_workers()
+        else:
+            available = status['available']
+        self.free_at = sorted([now] * available +
+                              [now + secs for secs in status['slots']])
+        self.checked = now
+
+    def acquire(self, on_wait=None):
+        ''' Block until a slot is free. '''
+        with self.lock:
+            while True:
+                now = time()
+                if now < self.not_before:
+                    sleep(self.not_before - now)
+                    continue
+                if not self.free_at or now - self.checked > status_max_age:
+                    self.refresh()
+                if not self.free_at:
+                    # every slot is running a query, no release time yet
+                    sleep(5)
+                    continue
+                secs = self.free_at[0] - time()
+                if secs <= 0:
+                    self.free_at.pop(0)
+                    return
+                if on_wait:
+                    on_wait(int(secs) + 1)
+                sleep(secs + 1)
+                self.free_at = []  # check the status page again
+
+    def rate_limited(self):
+        ''' Called after a 429 response, back off for longer each time. '''
+        self.rate_limited_count += 1
+        secs = min(5 * 2 ** self.rate_limited_count, 300)
+        print(f'rate limited, backing off for {secs} seconds')
+        self.not_before = time() + secs
+        self.free_at = []
+
+    def success(self):
+        self.rate_limited_count = 0
+
+overpass_slots = OverpassSlots()
+
+def chunk_workers():
+    return app.config.get('OVERPASS_CHUNK_WORKERS', default_chunk_workers)
+
+def chunk_filename(chunk):
+    return 'overpass/' + chunk['filename']
+
+def chunk_complete(chunk):
+    return overpass.xml_complete(chunk_filename(chunk))
+
+def outstanding_chunks(chunks):
+    return sum(1 for chunk in chunks
+               if chunk.get('oql') and not chunk_complete(chunk))
+
+def state_filename():
+    return app.config.get('TASK_QUEUE_STATE', 'overpass/task_queue.json')
+
+def save_state():
+    ''' Write the queued places to disk, so they survive a restart. '''
+    state = [{'place': job['place'], 'chunks': job['chunks']}
+             for job in sorted(jobs.values(), key=lambda job: job['id'])]
+    filename = state_filename()
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as out:
+        json.dump(state, out)
+    os.replace(tmp, filename)
+
+def load_state():
+    filename = state_filename()
+    if not os.path.exists(filename):
+        return
+    for entry in json.load(open(filename)):
+        print('resuming place', entry['place']['place_id'])
+        job = new_job(entry['place'], entry['chunks'])
+        spawn_later(resume_timeout, expire_unclaimed, job)
+
+def expire_unclaimed(job):
+    if job['subscribers'] or job['finished']:
+        return
+    print('no client for resumed place', job['place']['place_id'])
+    job['cancelled'] = True
+    end_job(job)
+
+def new_job(place, chunks):
+    job = {
+        'id': next(job_counter),
+        'place': place,
+        'chunks': chunks,
+        'subscribers': [],
+        'sent': [],
+        'remaining': len(chunks),
+        'outstanding': outstanding_chunks(chunks),
+        'failed': False,
+        'cancelled': False,
+        'finished': False,
+    }
+    jobs[place['place_id']] = job
+    task_queue.put((job['outstanding'], job['id'], job))
+    save_state()
+    return job
+
+def subscribe(job, send_queue):
+    job['subscribers'].append(send_queue)
+    for msg in job['sent']:  # chunks completed before this client arrived
+        send_queue.put(msg)
+
+def unsubscribe(job, send_queue):
+    if send_queue in job['subscribers']:
+        job['subscribers'].remove(send_queue)
+    if job['subscribers'] or job['finished']:
+        return
+    print('no clients left, cancel place', job['place']['place_id'])
+    job['cancelled'] = True
+    end_job(job)
+
+def end_job(job):
+    job['finished'] = True
+    if jobs.get(job['place']['place_id']) is job:
+        del jobs[job['place']['place_id']]
+        save_state()
+    for send_queue in job['subscribers']:
+        send_queue.put(None)
+
+def job_send(job, msg_type, msg):
     msg['type'] = msg_type
-    send_queue.put(msg)
-
-def wait_for_slot(send_queue):
-    print('get status')
-    try:
-        status = overpass.get_status()
-    except overpass.OverpassError as e:
-        r = e.args[0]
-        body = f'URL: {r.url}\n\nresponse:\n{r.text}'
-        mail.send_mail('Overpass API unavailable', body)
-        send_queue.put({'type': 'error',
-                        'error': "Can't access overpass API"})
-        return False
-    except requests.exceptions.Timeout:
-        body = 'Timeout talking to overpass API'
-        mail.send_mail('Overpass API timeout', body)
-        send_queue.put({'type': 'error',
-                        'error': "Can't access overpass API"})
-        return False
-
-    print('status:', status)
-    if not status['slots']:
-        return True
-    secs = status['slots'][0]
-    if secs <= 0:
-        return True
-    send_queue.put({'type': 'status', 'wait': secs})
-    sleep(secs)
-    return True
+    if msg_type == 'chunk':
+        job['sent'].append(msg)
+    for send_queue in job['subscribers']:
+        send_queue.put(msg)
+
+def job_done(job):
+    job['remaining'] -= 1
+    if job['remaining'] == 0 and not job['finished']:
+        print('item complete')
+        end_job(job)
+
+def job_error(job, error):
+    if job['finished']:
+        return
+    job['failed'] = True
+    job_send(job, 'error', {'error': error})
+    end_job(job)
 
 def process_queue_loop():
     with app.app_context():
+        for i in range(chunk_workers()):
+            spawn(chunk_worker_loop)
         while True:
             process_queue()
 
 def process_queue():
-    area, item = task_queue.get()
-    place = item['place']
-    send_queue = item['queue']
-    for num, chunk in enumerate(item['chunks']):
-        oql = chunk.get('oql')
-        if not oql:
+    ''' Take the next place from the queue and hand its chunks to the chunk
+        workers, chunks that are already downloaded are reported at once. '''
+    outstanding, job_id, job = task_queue.get()
+    if job['cancelled']:
+        return
+    place = job['place']
+    if not job['remaining']:
+        end_job(job)
+        return
+    for num, chunk in enumerate(job['chunks']):
+        if job['finished']:
+            break
+        if not chunk.get('oql'):
+            job_done(job)
             continue
-        filename = 'overpass/' + chunk['filename']
-        msg = {
-            'num': num,
-            'filename': chunk['filename'],
-            'place': place,
-        }
-        if not os.path.exists(filename):
-            utils.check_free_space(app.config)
-            if not wait_for_slot(send_queue):
-                return
-            to_client(send_queue, 'run_query', msg)
-            print('run query')
-            r = overpass.run_query(oql)
-            print('query complete')
-            with open(filename, 'wb') as out:
-                out.write(r.content)
-            utils.check_free_space(app.config)
-        print(msg)
-        to_client(send_queue, 'chunk', msg)
-    print('item complete')
-    send_queue.put(None)
+        if chunk_complete(chunk):
+            msg = {'num': num, 'filename': chunk['filename'], 'place': place}
+            job_send(job, 'chunk', msg)
+            job_done(job)
+            continue
+        chunk_queue.put(((outstanding, job_id, num), job, chunk))
+
+def chunk_worker_loop():
+    with app.app_context():
+        while True:
+            priority, job, chunk = chunk_queue.get()
+            try:
+                download_chunk(priority[2], job, chunk)
+            except Exception:
+                # keep the worker running, the job fails instead of hanging
+                traceback.print_exc()
+                job_error(job, 'Error downloading from Overpass')
+                job_done(job)
+                info = 'chunk: {}\n'.format(chunk.get('filename'))
+                try:
+                    mail.send_traceback(info)
+                except Exception:
+                    traceback.print_exc()
+
+def download_chunk(num, job, chunk):
+    if job['finished']:
+        return job_done(job)
+
+    filename = chunk_filename(chunk)
+    msg = {
+        'num': num,
+        'filename': chunk['filename'],
+        'place': job['place'],
+    }
+
+    def on_wait(secs):
+        job_send(job, 'status', {'wait': secs})
+
+    utils.check_free_space(app.config)
+    refresh = chunk.get('refresh', False)
+    cached = None if refresh else overpass.cache_lookup(chunk['oql'])
+    if cached:  # another place already downloaded this chunk
+        overpass.copy_from_cache(cached, filename)
+        job_send(job, 'chunk', msg)
+        return job_done(job)
+
+    while True:
+        try:
+            overpass_slots.acquire(on_wait=on_wait)
+        except OverpassUnavailable:
+            job_error(job, "Can't access overpass API")
+            return job_done(job)
+        if job['finished']:
+            return job_done(job)
+
+        job_send(job, 'run_query', dict(msg))
+        print('run query')
+        try:
+            overpass.run_query_to_file(chunk['oql'], filename,
+                                       refresh=refresh)
+        except overpass.RateLimited:
+            overpass_slots.rate_limited()
+            continue
+        except overpass.OverpassError as e:
+            mail.error_mail('overpass chunk ' + e.error, chunk['oql'], e.r,
+                            via_web=False, reply=e.reply)
+            job_error(job, 'Overpass returned an error')
+            return job_done(job)
+        overpass_slots.success()
+        print('query complete')
+        break
+
+    utils.check_free_space(app.config)
+    print(msg)
+    job_send(job, 'chunk', msg)
+    job_done(job)
 
 class Request:
     def __init__(self, sock, address):
         self.address = address
         self.sock = sock
+        self.reader = netstring.Reader(sock)
         self.send_queue = None
+        self.job = None
 
     def send_msg(self, msg, check_ack=True):
         netstring.write(self.sock, json.dumps(msg))
         if check_ack:
-            msg = netstring.read(self.sock)
+            msg = self.reader.read()
+            if msg is None:
+                raise ConnectionError('client closed connection')
             assert msg == 'ack'
 
     def reply_and_close(self, msg):
@@ -116,19 +342,32 @@ class Request:
 
     def new_place_request(self, msg):
         self.send_queue = Queue()
-        task_queue.put((msg['place']['area'], {
-            'place': msg['place'],
-            'address': self.address,
-            'chunks': msg['chunks'],
-            'queue': self.send_queue,
-        }))
+        self.job = jobs.get(msg['place']['place_id'])
+        if self.job:
+            print('joining existing request')
+        else:
+            self.job = new_job(msg['place'], msg['chunks'])
+        subscribe(self.job, self.send_queue)
 
         self.send_msg({'type': 'connected'})
 
+    def next_msg(self):
+        try:
+            return self.send_queue.get(timeout=heartbeat_interval)
+        except Empty:
+            return {'type': 'heartbeat'}
+
     def handle(self):
         print('New connection from %s:%s' % self.address)
         try:
-            msg = json.loads(netstring.read(self.sock))
+            from_network = self.reader.read()
+        except (ConnectionError, EOFError):
+            from_network = None
+        if from_network is None:
+            print('client closed connection before sending a request')
+            return self.sock.close()
+        try:
+            msg = json.loads(from_network)
         except json.decoder.JSONDecodeError:
             msg = {'type': 'error', 'error': 'invalid JSON'}
             return self.reply_and_close(msg)
@@ -139,16 +378,17 @@ class Request:
         self.new_place_request(msg)
         error = False
         try:
-            to_send = self.send_queue.get()
+            to_send = self.next_msg()
             while to_send:
                 self.send_msg(to_send)
                 if to_send['type'] == 'error':
                     error = True
-                to_send = self.send_queue.get()
-        except BrokenPipeError:
+                to_send = self.next_msg()
+        except (ConnectionError, EOFError):
             print('socket closed')
+            unsubscribe(self.job, self.send_queue)
         else:
-            if not error:
+            if not error and not self.job['cancelled']:
                 print('request complete')
                 self.send_msg({'type': 'done'})
 
@@ -160,6 +400,7 @@ def handle_request(sock, address):
 
 def main():
     utils.check_free_space(app.config)
+    load_state()
     spawn(process_queue_loop)
     print('listening on port {}'.format(port))
     server = StreamServer((listen_host, port), handle_request)
@@ -1056,3 +1056,46 @@ def test_school_shouldnt_match_church(monkeypatch):
     ret = matcher.check_item_candidate(candidate)
     print(ret)
     assert 'reject' in ret
+
+def test_osm_table():
+    assert matcher.osm_table('osm_123', 'point') == 'osm_123_point'
+
+    sql = matcher.osm_table(matcher.SharedTables(123), 'polygon')
+    assert 'from osm_polygon o' in sql
+    assert "m.tbl = 'polygon'" in sql
+    assert 'm.place_id = 123' in sql
+    assert sql.endswith(') polygon')
+
+    assert matcher.osm_table('osm_123', 'polygon', 'b') == 'osm_123_polygon b'
+    assert matcher.osm_table(matcher.SharedTables(123), 'polygon', 'b').endswith(') b')
+
+def test_find_item_matches_shared_tables(monkeypatch):
+    sql_run = []
+
+    def mock_run_sql(cur, sql, debug):
+        sql_run.append(sql)
+        if not sql.startswith('select * from'):
+            return []
+        return [('polygon', 1, None, {'landuse': 'retail', 'name': 'Oxmoor Mall'}, 0)]
+
+    class RecordingDatabase(MockDatabase):
+        def execute(self, sql):
+            sql_run.append(sql)
+
+    monkeypatch.setattr(matcher, 'run_sql', mock_run_sql)
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+
+    test_entity = {
+        'claims': {},
+        'labels': {'en': {'language': 'en', 'value': 'Oxmoor Center'}},
+        'sitelinks': {},
+    }
+    item = Item(entity=test_entity, tags=['landuse=retail'])
+    source = matcher.SharedTables(123)
+    candidates = matcher.find_item_matches(RecordingDatabase(), item, source)
+    assert len(candidates) == 1
+
+    assert not any('SharedTables' in sql for sql in sql_run)
+    geom_sql = sql_run[-1]
+    assert geom_sql.startswith('select ST_AsText')
+    assert 'm.place_id = 123' in geom_sql
@@ -63,3 +63,17 @@ def test_calculate_tags(monkeypatch):
     result = item.calculate_tags()
     assert 'building' not in result
     assert result == tags | {'leisure=park'}
+
+def test_match_fingerprint(monkeypatch):
+    entity = {'lastrevid': 100, 'labels': {}, 'sitelinks': {}}
+    item = Item(entity=entity, tags=['amenity=pub', 'building'])
+    fingerprint = item.match_fingerprint()
+
+    same = Item(entity=dict(entity), tags=['building', 'amenity=pub'])
+    assert same.match_fingerprint() == fingerprint
+
+    edited = Item(entity=dict(entity, lastrevid=101), tags=['building', 'amenity=pub'])
+    assert edited.match_fingerprint() != fingerprint
+
+    monkeypatch.setattr(matcher, 'matcher_version', matcher.matcher_version + 1)
+    assert item.match_fingerprint() != fingerprint
@@ -0,0 +1,35 @@
+from matcher import netstring
+import socket
+import pytest
+
+def test_frame():
+    assert netstring.frame('ack') == b'3:ack,'
+    assert netstring.frame('café') == b'5:caf\xc3\xa9,'
+
+def test_read_write():
+    a, b = socket.socketpair()
+    reader = netstring.Reader(b)
+
+    netstring.write(a, 'hello')
+    netstring.write(a, '')
+    big = 'x' * 100000
+    netstring.write(a, big)
+    a.sendall(b'5:ca')  # message split across two sends
+    a.sendall('fé,'.encode('utf-8'))
+    a.sendall(b'10:trunc')
+    a.close()
+
+    assert reader.read() == 'hello'
+    assert reader.read() == ''
+    assert reader.read() == big
+    assert reader.read() == 'café'
+    with pytest.raises(EOFError):
+        reader.read()
+
+def test_read_end_of_stream():
+    a, b = socket.socketpair()
+    netstring.write(a, 'ack')
+    a.close()
+    reader = netstring.Reader(b)
+    assert reader.read() == 'ack'
+    assert reader.read() is None
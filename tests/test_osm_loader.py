@@ -0,0 +1,122 @@
+from matcher import osm_loader
+
+osm_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="52.0" lon="0.0"/>
+  <node id="2" lat="52.0" lon="0.001"/>
+  <node id="3" lat="52.001" lon="0.001"/>
+  <node id="4" lat="52.001" lon="0.0">
+    <tag k="amenity" v="pub"/>
+    <tag k="name" v="The &quot;Eagle&quot;"/>
+  </node>
+  <node id="5" lat="52.002" lon="0.0">
+    <tag k="created_by" v="JOSM"/>
+  </node>
+  <way id="10">
+    <nd ref="1"/><nd ref="2"/><nd ref="3"/><nd ref="4"/><nd ref="1"/>
+    <tag k="building" v="yes"/>
+  </way>
+  <way id="11">
+    <nd ref="1"/><nd ref="2"/><nd ref="3"/><nd ref="4"/><nd ref="1"/>
+    <tag k="highway" v="pedestrian"/>
+  </way>
+  <way id="12">
+    <nd ref="1"/><nd ref="2"/>
+  </way>
+  <relation id="20">
+    <member type="way" ref="12" role="outer"/>
+    <member type="way" ref="99" role="outer"/>
+    <tag k="type" v="multipolygon"/>
+  </relation>
+  <relation id="21">
+    <member type="way" ref="12" role=""/>
+    <tag k="type" v="site"/>
+  </relation>
+</osm>
+'''
+
+def test_parse(tmpdir):
+    filename = tmpdir.join('test.xml')
+    filename.write(osm_xml)
+
+    rows = {(table, osm_id): (tags, wkt)
+            for table, osm_id, tags, wkt in osm_loader.parse(str(filename))}
+
+    assert set(rows) == {('point', 4), ('polygon', 10), ('line', 11),
+                         ('multipolygon', -20)}
+    assert rows[('point', 4)][0]['name'] == 'The "Eagle"'
+    assert rows[('point', 4)][1].startswith('POINT(0.00 ')
+    assert rows[('polygon', 10)][1].startswith('POLYGON((')
+    assert rows[('multipolygon', -20)][1].count('(') == 2
+
+def test_copy_lines():
+    rows = [('point', 4, {'name': 'a\tb "c"'}, 'POINT(1.00 2.00)')]
+    line = next(osm_loader.copy_lines(rows))
+    assert line == 'point\t4\t"name"=>"a\\tb \\\\"c\\\\""\tSRID=3857;POINT(1.00 2.00)\n'
+
+def test_line_reader():
+    reader = osm_loader.LineReader(iter(['abc\n', 'de\n', 'f\n']))
+    assert reader.read(2) == 'ab'
+    assert reader.read(4) == 'c\nde'
+    assert reader.read() == '\nf\n'
+    assert reader.read(10) == ''
+
+adiff_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <action type="create">
+    <node id="6" lat="52.0" lon="0.0"><tag k="amenity" v="cafe"/></node>
+  </action>
+  <action type="modify">
+    <old><way id="11"><nd ref="1" lat="52.0" lon="0.0"/><nd ref="2" lat="52.0" lon="0.001"/><tag k="highway" v="pedestrian"/></way></old>
+    <new><way id="11"><nd ref="1" lat="52.0" lon="0.0"/><nd ref="2" lat="52.0" lon="0.002"/><tag k="highway" v="pedestrian"/></way></new>
+  </action>
+  <action type="delete">
+    <old><node id="4" lat="52.001" lon="0.0"><tag k="amenity" v="pub"/></node></old>
+    <new><node id="4" visible="false"/></new>
+  </action>
+</osm>
+'''
+
+osm_change_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <modify><node id="4" lat="52.001" lon="0.0"><tag k="amenity" v="bar"/></node></modify>
+  <delete><way id="10"/></delete>
+</osmChange>
+'''
+
+def test_parse_change(tmpdir):
+    filename = tmpdir.join('adiff.xml')
+    filename.write(adiff_xml)
+    changes = list(osm_loader.parse_change(str(filename)))
+    assert [c[:3] for c in changes] == [('create', 'node', 6),
+                                        ('modify', 'way', 11),
+                                        ('delete', 'node', 4)]
+    assert changes[0][4][0] == 'point'
+    assert changes[1][4][:2] == ('line', 11)
+
+    filename = tmpdir.join('change.osc')
+    filename.write(osm_change_xml)
+    changes = list(osm_loader.parse_change(str(filename)))
+    assert [c[:3] for c in changes] == [('modify', 'node', 4),
+                                        ('delete', 'way', 10)]
+    assert changes[0][3] == {'amenity': 'bar'}
+    assert changes[1][4] is None
+
+def test_apply_change_keeps_other_places(tmpdir):
+    class RecordingCursor:
+        def __init__(self):
+            self.sql = []
+
+        def execute(self, sql, params=None):
+            self.sql.append((sql, params))
+
+    filename = tmpdir.join('adiff.xml')
+    filename.write(adiff_xml)
+    cur = RecordingCursor()
+    changes = osm_loader.parse_change(str(filename))
+    assert osm_loader.apply_change(cur, 'osm', changes, place_id=7) == 3
+
+    removed = [params for sql, params in cur.sql
+               if sql.startswith('delete from osm_place_object where tbl')]
+    # only the deleted node loses its memberships, modified way 11 keeps them
+    assert removed == [['point', 4]]
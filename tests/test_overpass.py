@@ -1,5 +1,8 @@
+import os
+from matcher import overpass
 from matcher.overpass import oql_from_tag, oql_for_area, group_tags
 from pprint import pprint
+from datetime import datetime
 
 tags = ['admin_level', 'amenity=arts_centre',
         'amenity=astronomical_observatory', 'amenity=bar', 'amenity=clock',
@@ -102,3 +105,120 @@ def test_group_tags():
     }
 
     assert ret == expect
+
+def test_parse_status():
+    class Response:
+        text = '''Connected as: 1234
+Current time: 2019-01-01T12:00:00Z
+Rate limit: 3
+Slot available after: 2019-01-01T12:00:20Z, in 20 seconds.
+2 slots available now.
+Currently running queries (pid, space limit, time limit, start time):
+'''
+
+    status = overpass.parse_status(Response())
+    assert status['rate_limit'] == 3
+    assert status['slots'] == [20]
+    assert status['available'] == 2
+
+def test_xml_complete(tmpdir):
+    complete = tmpdir.join('complete.xml')
+    complete.write('<?xml version="1.0"?>\n<osm>\n<node id="1"/>\n</osm>\n')
+    assert overpass.xml_complete(str(complete))
+
+    truncated = tmpdir.join('truncated.xml')
+    truncated.write('<?xml version="1.0"?>\n<osm>\n<node id="1"/>\n<no')
+    assert not overpass.xml_complete(str(truncated))
+
+    error = tmpdir.join('error.xml')
+    error.write('<osm>\n<remark> runtime error: Query timed out </remark>\n</osm>\n')
+    assert not overpass.xml_complete(str(error))
+
+    assert not overpass.xml_complete(str(tmpdir.join('missing.xml')))
+
+def test_download_error():
+    ok = b'<?xml version="1.0"?>\n<osm>\n'
+    assert overpass.download_error(ok, b'<node id="1"/>\n</osm>\n') is None
+    assert overpass.download_error(ok, b'<node id="1"/>\n<no') == 'incomplete'
+
+    gateway = b'<html><head><title>504 Gateway Time-out</title></head></html>'
+    assert overpass.download_error(gateway, gateway) == 'timeout'
+
+    tail = b'<remark> runtime error: Query run out of memory </remark>\n</osm>\n'
+    assert overpass.download_error(ok, tail) == 'out of memory'
+
+def test_normalize_oql():
+    a = '[timeout:600][out:xml];\n  area(3600062149) -> .a;\n  node(area.a)["name"="A  B"];\nout;'
+    b = '[out:xml];  area(3600062149)  -> .a; node(area.a)["name"="A  B"]; out;'
+    assert overpass.normalize_oql(a) == overpass.normalize_oql(b)
+    assert '"A  B"' in overpass.normalize_oql(a)
+
+def test_adiff_oql():
+    oql = '[timeout:600][out:xml];\n(node(1);way(2););\n(._;>;);\nout qt;'
+    since = datetime(2020, 1, 2, 3, 4, 5)
+    expect = ('[timeout:600][out:xml][adiff:"2020-01-02T03:04:05Z"];\n'
+              '(node(1);way(2););\nout geom;')
+    assert overpass.adiff_oql(oql, since) == expect
+
+def test_evict_cache(tmpdir, monkeypatch):
+    class MockApp:
+        config = {'OVERPASS_DIR': str(tmpdir),
+                  'OVERPASS_CACHE_TTL': 3600,
+                  'OVERPASS_CACHE_MAX_SIZE': 250}
+    monkeypatch.setattr(overpass, 'current_app', MockApp)
+
+    cache = tmpdir.mkdir('cache').mkdir('ab')
+    now = overpass.time()
+    for num, age in enumerate([7200, 300, 200, 100]):
+        f = cache.join('{}.xml'.format(num))
+        f.write('x' * 100)
+        f.setmtime(now - age)
+    overpass.os.utime(str(cache.join('1.xml')), (now, now - 300))
+
+    overpass.evict_cache(force=True)
+    assert sorted(f.basename for f in cache.listdir()) == ['1.xml', '3.xml']
+
+def test_xml_complete_gzip(tmpdir):
+    f = tmpdir.join('complete.xml')
+    f.write('<?xml version="1.0"?>\n<osm>\n<node id="1"/>\n</osm>\n')
+    overpass.utils.gzip_file(str(f))
+    assert overpass.xml_complete(str(f))
+
+    # only complete downloads are compressed, the file isn't read again
+    f.write_binary(f.read_binary()[:-20])
+    assert overpass.xml_complete(str(f))
+
+def test_run_query_to_file_refresh(tmpdir, monkeypatch):
+    class MockApp:
+        config = {'OVERPASS_DIR': str(tmpdir)}
+    monkeypatch.setattr(overpass, 'current_app', MockApp)
+    monkeypatch.setattr(overpass, 'endpoint', lambda: 'https://example.org/')
+
+    downloads = []
+    def mock_download(oql, filename):
+        downloads.append(oql)
+        with open(filename, 'w') as f:
+            f.write('<osm>{}</osm>'.format(len(downloads)))
+    monkeypatch.setattr(overpass, 'download_to_file', mock_download)
+
+    filename = str(tmpdir.join('place.xml'))
+    overpass.run_query_to_file('[out:xml];node(1);out;', filename)
+    overpass.run_query_to_file('[out:xml];node(1);out;', filename)
+    assert len(downloads) == 1
+
+    overpass.run_query_to_file('[out:xml];node(1);out;', filename, refresh=True)
+    assert len(downloads) == 2
+    assert tmpdir.join('place.xml').read() == '<osm>2</osm>'
+
+def test_save_elements(tmpdir, monkeypatch):
+    class MockResponse:
+        def iter_content(self, chunk_size):
+            yield b'{"elements": [{"id": 1}, '
+            yield b'{"id": 2}]}'
+
+    monkeypatch.setattr(overpass, 'run_query', lambda oql, stream: MockResponse())
+    filename = str(tmpdir.join('query.json'))
+    tmpdir.join('query.json.tmp').write('left by another worker')
+
+    assert overpass.save_elements('oql', filename) == [{'id': 1}, {'id': 2}]
+    assert sorted(os.listdir(str(tmpdir))) == ['query.json', 'query.json.tmp']
@@ -1,4 +1,5 @@
 from matcher import utils
+import json
 import pytest
 
 def test_normalize_url():
@@ -53,3 +54,77 @@ def test_display_distance():
     assert utils.display_distance(units, 500) == '500 metres'
     assert utils.display_distance(units, 1000) == '0.62 miles'
     assert utils.display_distance(units, 10_000) == '6.21 miles'
+
+def test_run_in_threads():
+    assert utils.run_in_threads(lambda i: i * 2, [3, 1, 2]) == [6, 2, 4]
+    assert utils.run_in_threads(lambda i: i, []) == []
+
+def test_imap_in_threads():
+    consumed = []
+
+    def numbers():
+        for i in range(10):
+            consumed.append(i)
+            yield i
+
+    results = utils.imap_in_threads(lambda i: i * i, numbers(), max_workers=3)
+    assert next(results) == 0
+    assert len(consumed) < 10
+    assert list(results) == [i * i for i in range(1, 10)]
+
+def test_iter_json_array():
+    doc = {'head': {'vars': ['place']},
+           'results': {'bindings': [{'place': {'value': 'Q{}'.format(i)}}
+                                    for i in range(100)]}}
+    data = json.dumps(doc).encode('utf-8')
+    chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+
+    rows = list(utils.iter_json_array(chunks, 'bindings'))
+    assert rows == doc['results']['bindings']
+
+    assert list(utils.iter_json_array([b'{"elements": []}'], 'elements')) == []
+
+    with pytest.raises(ValueError):
+        list(utils.iter_json_array([data[:-50]], 'bindings'))
+
+def test_lock_slot(tmpdir):
+    lock_dir = str(tmpdir.join('locks'))
+
+    class Blocked(Exception):
+        pass
+
+    def on_wait():
+        raise Blocked
+
+    with utils.lock_slot(lock_dir, 2) as first:
+        with utils.lock_slot(lock_dir, 2) as second:
+            assert {first, second} == {0, 1}
+            with pytest.raises(Blocked):
+                with utils.lock_slot(lock_dir, 2, on_wait=on_wait):
+                    pass
+        with utils.lock_slot(lock_dir, 2, on_wait=on_wait) as num:
+            assert num == second
+
+def test_gzip_file(tmpdir):
+    f = tmpdir.join('data.xml')
+    content = b'<osm>\n' + b'<node id="1"/>\n' * 1000 + b'</osm>\n'
+    f.write_binary(content)
+    filename = str(f)
+
+    assert not utils.is_gzip(filename)
+    assert utils.data_size(filename) == len(content)
+
+    utils.gzip_file(filename)
+    assert utils.is_gzip(filename)
+    assert f.size() < len(content)
+    assert utils.data_size(filename) == len(content)
+    with utils.open_data(filename) as data:
+        assert data.read() == content
+
+def test_data_size_small_gzip(tmpdir):
+    f = tmpdir.join('empty.xml')
+    f.write_binary(b'')
+    filename = str(f)
+    utils.gzip_file(filename)
+    assert f.size() > 0
+    assert utils.data_size(filename) == 0
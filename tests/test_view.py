@@ -388,7 +388,7 @@ def test_api_get(monkeypatch):
     monkeypatch.setattr(view.Item, 'query', MockQuery)
     monkeypatch.setattr(overpass, 'get_existing', lambda qid: [])
 
-    def item_query(oql, qid, radius):
+    def item_query(oql, refresh=False):
         return [{
             'type': 'node',
             'id': 1834851585,
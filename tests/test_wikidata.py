@@ -524,3 +524,136 @@ def test_parse_enwiki_query():
     }
 
     assert wikidata.parse_enwiki_query(rows) == expect
+
+def test_cached_entity_iter(monkeypatch, tmpdir):
+    monkeypatch.setattr(wikidata, 'entity_store_dir', lambda: str(tmpdir))
+    monkeypatch.setattr(wikidata, 'entity_store_max_age', lambda: 0)
+
+    revisions = {'Q1': 10, 'Q2': 20}
+    downloaded = []
+
+    def mock_entity_iter(ids, debug=False):
+        for qid in ids:
+            downloaded.append(qid)
+            yield qid, {'id': qid, 'lastrevid': revisions[qid]}
+
+    monkeypatch.setattr(wikidata, 'entity_iter', mock_entity_iter)
+    monkeypatch.setattr(wikidata, 'get_lastrevids',
+                        lambda ids: {qid: revisions[qid] for qid in ids})
+
+    result = dict(wikidata.cached_entity_iter(['Q1', 'Q2']))
+    assert result['Q1']['lastrevid'] == 10
+    assert downloaded == ['Q1', 'Q2']
+
+    downloaded.clear()
+    revisions['Q2'] = 21
+    result = dict(wikidata.cached_entity_iter(['Q1', 'Q2']))
+    assert downloaded == ['Q2']
+    assert result['Q2']['lastrevid'] == 21
+
+    downloaded.clear()
+    known = {'Q1': {'id': 'Q1', 'lastrevid': 9}}
+    result = dict(wikidata.cached_entity_iter(['Q1'], known=known))
+    assert downloaded == ['Q1']
+    assert result['Q1']['lastrevid'] == 10
+
+def test_trim_entity():
+    entity = {
+        'id': 'Q1',
+        'lastrevid': 5,
+        'labels': {'en': {'language': 'en', 'value': 'test'}},
+        'descriptions': {'en': {'language': 'en', 'value': 'test item'}},
+        'sitelinks': {},
+        'claims': {
+            'P31': [{
+                'mainsnak': {'snaktype': 'value', 'property': 'P31',
+                             'hash': 'abc',
+                             'datavalue': {'value': {'id': 'Q5'}}},
+                'rank': 'normal',
+                'qualifiers': {'P580': []},
+                'references': [],
+            }],
+            'P569': [{'mainsnak': {}, 'rank': 'normal'}],
+        },
+    }
+    trimmed = wikidata.trim_entity(entity)
+    assert 'descriptions' not in trimmed
+    assert trimmed['lastrevid'] == 5
+    assert list(trimmed['claims']) == ['P31']
+    assert trimmed['claims']['P31'] == [{
+        'mainsnak': {'snaktype': 'value', 'property': 'P31',
+                     'datavalue': {'value': {'id': 'Q5'}}},
+        'rank': 'normal',
+    }]
+    assert wikidata.trim_entity(trimmed) == trimmed
+
+def test_isa_from_graph():
+    graph = {
+        'Q2': {'qid': 'Q2', 'label': 'Grade II listed building',
+               'children': {'Q3'}, 'country': {'qid': 'Q21', 'label': 'England'}},
+        'Q3': {'qid': 'Q3', 'label': 'listed building', 'children': {'Q4'}},
+        'Q4': {'qid': 'Q4', 'label': 'building', 'children': set()},
+        'Q5': {'qid': 'Q5', 'label': 'church building', 'children': {'Q4'}},
+    }
+    item_types = {'Q1': ['Q2'], 'Q6': ['Q5'], 'Q7': ['Q8']}
+
+    expect = {
+        'Q1': [{'qid': 'Q2', 'label': 'Grade II listed building (listed building)'}],
+        'Q6': [{'qid': 'Q5', 'label': 'church building'}],
+    }
+    assert wikidata.isa_from_graph(graph, item_types) == expect
+
+    # the graph is shared between items, so it must not be modified
+    assert graph['Q2']['label'] == 'Grade II listed building'
+    assert graph['Q2']['children'] == {'Q3'}
+
+def test_stream_query(monkeypatch):
+    import requests
+    import threading
+
+    class MockResponse:
+        status_code = 200
+
+        def __init__(self, parts):
+            self.parts = parts
+
+        def iter_content(self, chunk_size):
+            for part in self.parts:
+                if isinstance(part, Exception):
+                    raise part
+                yield part
+
+        def close(self):
+            pass
+
+    bindings = b'{"results": {"bindings": [{"a": 1}, {"a": 2}, {"a": 3}]}}'
+    responses = [
+        MockResponse([requests.exceptions.ChunkedEncodingError()]),
+        MockResponse([bindings[:30], bindings[30:]]),
+        MockResponse([bindings[:46], requests.exceptions.ChunkedEncodingError()]),
+    ]
+    monkeypatch.setattr(wikidata.requests, 'post',
+                        lambda *args, **kwargs: responses.pop(0))
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(wikidata, 'query_slots', slots)
+
+    # the first attempt fails before any rows, so it is retried
+    assert list(wikidata.stream_query('query')) == [{'a': 1}, {'a': 2}, {'a': 3}]
+    assert slots.acquire(blocking=False)
+    slots.release()
+
+    # an error after rows have been yielded can't be retried
+    rows = wikidata.stream_query('query', send_error_mail=False)
+    assert next(rows) == {'a': 1}
+    with pytest.raises(wikidata.QueryError):
+        next(rows)
+    assert slots.acquire(blocking=False)
+    slots.release()
+
+    # a query timeout is raised straight away instead of being retried
+    timeout = (b'{"results": {"bindings": [\n'
+               b'java.util.concurrent.TimeoutException')
+    responses[:] = [MockResponse([timeout]), MockResponse([bindings])]
+    with pytest.raises(wikidata.QueryTimeout):
+        list(wikidata.stream_query('query', send_error_mail=False))
+    assert len(responses) == 1
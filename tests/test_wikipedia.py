@@ -20,3 +20,32 @@ def test_bullet_list_html():
 
     expect = ['Shepherdstown Historic District']
     assert wikipedia.html_names(sample) == expect
+
+def test_extracts_iter(monkeypatch):
+    def mock_extracts_query(titles, language_code='en'):
+        return [{'title': t, 'extract': f'<p>{language_code} {t}</p>',
+                 'lastrevid': 1} for t in titles] + [{'title': 'missing'}]
+
+    monkeypatch.setattr(wikipedia, 'extracts_query', mock_extracts_query)
+
+    titles = {'en': ['t{}'.format(i) for i in range(45)], 'de': ['x']}
+    result = list(wikipedia.extracts_iter(titles))
+    assert len(result) == 46
+    assert result[0] == ('en', 't0', '<p>en t0</p>', 1)
+    assert ('de', 'x', '<p>de x</p>', 1) in result
+
+def test_pages_by_code():
+    titles = {'en': ['a', 'b', 'c', 'd', 'e'], 'de': ['x', 'y'], 'fr': ['z']}
+    pages = wikipedia.pages_by_code(titles, 2)
+    assert pages == [('en', ('a', 'b')), ('de', ('x', 'y')), ('fr', ('z',)),
+                     ('en', ('c', 'd')), ('en', ('e',))]
+
+def test_get_cats_normalized(monkeypatch):
+    def mock_query(titles, params, language_code='en'):
+        return {'normalized': [{'from': 'foo_bar', 'to': 'Foo bar'}],
+                'pages': [{'title': 'Foo bar', 'categories': []},
+                          {'title': 'Baz', 'categories': []}]}
+
+    monkeypatch.setattr(wikipedia, 'query', mock_query)
+    pages = wikipedia.get_cats(['foo_bar', 'Baz'])
+    assert [p['requested_title'] for p in pages] == ['foo_bar', 'Baz']